@@ -9,3 +9,11 @@ IGNORED = MYDEVICES
 HEIGHT = 1366 # in pixels
 WIDTH  = 768 # in pxiels
 DPI = 100
+
+CACHE_DIR = None # cache directory (default to next to the kismet db)
+CACHE_SIZE = 2*1024*1024*1024 # in bytes, least recently used entries are evicted above that
+
+CHECK = 'full' # integrity check of the db: none, header (and schema) or full
+CHECK_CACHE = None # file remembering the dbs which passed the full check (default to ~/.cache/kismet_timeplot/checks.json)
+MAX_MEMORY = None # in MiB, timelines above that are down-sampled (lists engine, default to no limit)
+SNAPSHOT = False # copy the time window to memory before querying it (for a db kismet is writing)
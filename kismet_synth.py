@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import datetime
+import argparse
+import itertools
+import random
+import sqlite3
+import sys
+import os.path
+import os
+
+VERSION = '0.1'
+BROADCAST = 'FF:FF:FF:FF:FF:FF'
+# number of packets generated and inserted at once
+CHUNK_SIZE = 100000
+# type of the generated devices and their weight
+DEVICE_TYPES = (('Wi-Fi Client', 60), ('Wi-Fi Device', 20), ('Wi-Fi AP', 15), ('Wi-Fi Bridged', 3), ('Wi-Fi Ad-Hoc', 2))
+
+# subset of the kismetdb schema, with the columns used by kismet_timeplot
+SCHEMA = (
+    'CREATE TABLE KISMET (kismet_version TEXT, db_version INT, db_module TEXT)',
+    'CREATE TABLE devices (first_time INT, last_time INT, devkey TEXT, phyname TEXT, devmac TEXT, strongest_signal INT, '
+        'min_lat REAL, min_lon REAL, max_lat REAL, max_lon REAL, avg_lat REAL, avg_lon REAL, bytes_data INT, type TEXT, device BLOB, '
+        'UNIQUE(phyname, devmac) ON CONFLICT REPLACE)',
+    'CREATE TABLE packets (ts_sec INT, ts_usec INT, phyname TEXT, sourcemac TEXT, destmac TEXT, transmac TEXT, frequency REAL, '
+        'devkey TEXT, lat REAL, lon REAL, alt REAL, speed REAL, heading REAL, packet_len INT, signal INT, datasource TEXT, dlt INT, '
+        'packet BLOB, error INT, tags TEXT, datarate REAL, hash INT, packetid INT, packet_full_len INT)',
+)
+
+def random_mac(rnd, laa):
+    # unicast address, with the locally administered bit set for LAA
+    first = rnd.randrange(256) & 0b11111100
+    if laa:
+        first |= 0b00000010
+    return ':'.join('%02X' % b for b in [first]+[rnd.randrange(256) for _ in range(5)])
+
+def generate(filename, packets=100000, devices=500, laa=0.3, datasources=1, rssi_mean=-70, rssi_std=10,
+        time_span=24*60*60, end=None, seed=0):
+    # write a kismet-like db, with packets evenly spread over time_span (in
+    # seconds) and a Zipf-like number of packets per device
+    if end is None:
+        end = datetime.datetime.now()
+    rnd = random.Random(seed)
+    end_sec = int(end.timestamp())
+    start_sec = end_sec - time_span
+
+    macs = list(dict.fromkeys(random_mac(rnd, rnd.random() < laa) for _ in range(devices)))
+    types = rnd.choices([t for t,_ in DEVICE_TYPES], weights=[w for _,w in DEVICE_TYPES], k=len(macs))
+    cum_weights = list(itertools.accumulate(1/(i+1) for i in range(len(macs))))
+    uuids = ['%08X-0000-0000-0000-%012X' % (rnd.randrange(2**32), i) for i in range(datasources)]
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    conn = sqlite3.connect(filename)
+    c = conn.cursor()
+    for sql in SCHEMA:
+        c.execute(sql)
+    c.execute('INSERT INTO KISMET VALUES (?, ?, ?)', ('synthetic', 8, 'kismet_synth'))
+
+    first_seen = {}
+    last_seen = {}
+    strongest = {}
+    done = 0
+    while done < packets:
+        n = min(CHUNK_SIZE, packets-done)
+        # timestamps of a chunk are sorted, and chunks follow each other
+        lo = start_sec + time_span*done/packets
+        hi = start_sec + time_span*(done+n)/packets
+        ts = sorted(rnd.uniform(lo, hi) for _ in range(n))
+        srcs = rnd.choices(macs, cum_weights=cum_weights, k=n)
+        rows = []
+        for t, src in zip(ts, srcs):
+            dst = BROADCAST if rnd.random() < 0.5 else rnd.choice(macs)
+            signal = min(-1, max(-100, int(rnd.gauss(rssi_mean, rssi_std))))
+            rows.append((int(t), int((t % 1)*1000000), 'IEEE802.11', src, dst, src, 2412000, signal, rnd.choice(uuids), 127, 0))
+            if src not in first_seen:
+                first_seen[src] = int(t)
+            last_seen[src] = int(t)
+            strongest[src] = max(strongest.get(src, -100), signal)
+        c.executemany('INSERT INTO packets (ts_sec, ts_usec, phyname, sourcemac, destmac, transmac, frequency, signal, datasource, dlt, error) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        done += n
+
+    rows = []
+    for i, (mac, t) in enumerate(zip(macs, types)):
+        if mac in first_seen:
+            rows.append((first_seen[mac], last_seen[mac], '4202770D00000000_%012X' % i, 'IEEE802.11', mac, strongest[mac], t, b'{}'))
+    rows.append((start_sec, end_sec, '4202770D00000000_FFFFFFFFFFFF', 'IEEE802.11', BROADCAST, 0, 'Wi-Fi Device', b'{}'))
+    c.executemany('INSERT INTO devices (first_time, last_time, devkey, phyname, devmac, strongest_signal, type, device) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+def parse_time_span(tmsp):
+    # same format as the --time-span of kismet_timeplot, in seconds
+    units = {'d':24*60*60, 'h':60*60, 'm':60}
+    seconds = 0
+    number = ''
+    for c in tmsp:
+        if c in '0123456789':
+            number += c
+        elif c in units and number:
+            seconds += int(number)*units[c]
+            number = ''
+        else:
+            raise ValueError(tmsp)
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic kismet db to benchmark kismet_timeplot')
+    parser.add_argument('-o', '--output', required=True, help='file name of the kismet db to write')
+    parser.add_argument('-n', '--packets', type=int, default=100000, help='number of packets')
+    parser.add_argument('-d', '--devices', type=int, default=500, help='number of devices')
+    parser.add_argument('--laa', type=float, default=0.3, help='fraction of devices with a LAA mac')
+    parser.add_argument('--datasources', type=int, default=1, help='number of datasources')
+    parser.add_argument('--rssi-mean', type=float, default=-70, help='mean of the RSSI (normal distribution)')
+    parser.add_argument('--rssi-std', type=float, default=10, help='standard deviation of the RSSI')
+    parser.add_argument('--time-span', default='1d', help='time span (expected format [###d][###h][###m]')
+    parser.add_argument('--end', help='time of the last packet (YYYY-mm-ddTHH:MM, default to now)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+
+    try:
+        time_span = parse_time_span(args.time_span)
+    except ValueError:
+        print('Error: --time-span argument should be of the form [:number:][d|h|m]', file=sys.stderr)
+        sys.exit(-1)
+    end = None
+    if args.end:
+        try:
+            end = datetime.datetime.strptime(args.end, '%Y-%m-%dT%H:%M')
+        except ValueError:
+            print("Error: can't parse date timestamp, excepted format YYYY-mm-ddTHH:MM", file=sys.stderr)
+            sys.exit(-1)
+    generate(args.output, args.packets, args.devices, args.laa, args.datasources, args.rssi_mean, args.rssi_std,
+        time_span, end, args.seed)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt as k:
+        pass
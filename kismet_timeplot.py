@@ -2,27 +2,94 @@
 
 import datetime
 import time
-from cycler import cycler
-import matplotlib
-#matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import matplotlib.patches as mpatches
+import numpy as np
 import argparse
 import sqlite3
 import sys
 import os.path
 import os
 import re
+import collections
+import copy
+import glob
+import multiprocessing
+import json
+import shutil
+import hashlib
+import array
+import contextlib
+import resource
+import threading
+import zipfile
+import random
+import mmap
 
 VERSION = '0.1'
 NUMOFSECSINADAY = 60*60*24
+# number of rows fetched at once from the packets table
+BATCH_SIZE = 10000
+# name of the cache directory created next to the db
+CACHE_DIRNAME = '.kismet_timeplot_cache'
+# columns extracted from the packets table in the cache
+CACHE_COLUMNS = ('ts_sec', 'ts_usec', 'src', 'dst', 'signal', 'datasource')
+CACHE_DTYPES = {'ts_sec':np.int64, 'ts_usec':np.int32, 'src':np.int32, 'dst':np.int32, 'signal':np.int16, 'datasource':np.int16}
+# stored in the cache in place of a NULL signal (never passes the rssi filter)
+NOSIGNAL = -32768
+# first bytes of any sqlite3 db
+SQLITE_HEADER = b'SQLite format 3\x00'
+# tables and columns read from the kismet db
+SCHEMA = {'packets': ('phyname', 'ts_sec', 'ts_usec', 'sourcemac', 'destmac', 'signal', 'datasource'), 'devices': ('phyname', 'devmac', 'type', 'last_time')}
+# covering indexes of the queries of --sql, created by --build-index in a copy of the db
+INDEXES = (
+    # time first, so that both queries only read the time window of the index
+    'create index if not exists kismet_timeplot_packets on packets (phyname, ts_sec, ts_usec, signal, datasource, sourcemac, destmac);',
+    'create index if not exists kismet_timeplot_devices on devices (phyname, devmac, type);',
+)
+# periods without any packet longer than that (in seconds) get a grey background
+IDLE_SHADING = 15*60
+# level of detail of the interactive viewer: packets are drawn one by one
+# below that number in the visible range (binned otherwise), the range is
+# only recomputed when the view stopped changing for LOD_DEBOUNCE ms, and
+# the last LOD_CACHE ranges are kept
+LOD_POINTS = 50000
+LOD_DEBOUNCE = 200
+LOD_CACHE = 16
+# busy timeout (in seconds) of --snapshot, then retries waiting twice longer each time
+SNAPSHOT_TIMEOUT = 0.1
+BUSY_RETRIES = 6
+BUSY_DELAY = 0.05
+# number of blocks of rowids read by --stats-sample
+STATS_BLOCKS = 1000
+# values written at once by --export
+EXPORT_CHUNK = 1000000
+# packets per chunk of the numpy engine, and grouped at once by sort_lanes
+SORT_CHUNK = 25000
+# image formats whose packets are rasterized, see save_image
+VECTOR_FORMATS = ('svg', 'svgz', 'pdf', 'eps', 'ps')
 # standard "tableau" colors without red and gray
 COLORS = ['tab:blue', 'tab:orange', 'tab:green', 'tab:purple', 'tab:brown', 'tab:pink', 'tab:olive', 'tab:cyan']
 
 # read config variable from config.py file
 import config
 
+# matplotlib is only imported when something is plotted, see load_matplotlib
+matplotlib = plt = ticker = mpatches = mcollections = cycler = None
+
+def load_matplotlib(args):
+    # deferred import of matplotlib, with the non-interactive Agg backend
+    # (no GUI backend discovery) when only writing an image
+    global matplotlib, plt, ticker, mpatches, mcollections, cycler
+    if plt is not None:
+        return
+    import matplotlib
+    if args.image:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import matplotlib.patches as mpatches
+    import matplotlib.collections as mcollections
+    from cycler import cycler
+
 # draws a rectangle as custom legend handler
 class MyLine2DHandler(object):
     def legend_artist(self, legend, orig_handle, fontsize, handlebox):
@@ -32,79 +99,394 @@ class MyLine2DHandler(object):
         handlebox.add_artist(patch)
         return patch
 
+def get_peak_rss():
+    # in KiB, ru_maxrss being in KiB on linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss//1024 if sys.platform == 'darwin' else rss
+
+class Profiler(object):
+    # wall time, cpu time and peak rss of each stage of a run, with the number
+    # of rows and macs in and out of each filter
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        # the caller fills the counts known at the end of the stage
+        st = dict(stage=name, **counts)
+        if not self.enabled:
+            yield st
+            return
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield st
+        finally:
+            st['wall'] = time.perf_counter()-wall
+            st['cpu'] = time.process_time()-cpu
+            st['peak_rss'] = get_peak_rss()
+            self.stages.append(st)
+
+    def report(self, dest):
+        if not self.enabled or not self.stages:
+            return
+        if dest.endswith('.json'):
+            with open(dest, 'w') as f:
+                json.dump({'stages': self.stages, 'total': sum(s['wall'] for s in self.stages)}, f, indent=1)
+            return
+        lines = [f'{"stage":12} {"wall":>8} {"cpu":>8} {"peak rss":>10} {"rows in":>9} {"rows out":>9} {"macs in":>8} {"macs out":>8}']
+        for s in self.stages:
+            counts = ''.join(f' {s[k]:>{w}}' if k in s else ' '*(w+1) for k,w in (('rows_in',9), ('rows_out',9), ('macs_in',8), ('macs_out',8)))
+            lines.append(f'{s["stage"]:12} {s["wall"]:8.3f} {s["cpu"]:8.3f} {s["peak_rss"]//1024:6} MiB{counts}'.rstrip())
+        lines.append(f'{"total":12} {sum(s["wall"] for s in self.stages):8.3f} {sum(s["cpu"] for s in self.stages):8.3f}')
+        if dest == '-':
+            print('\n'.join(lines), file=sys.stderr)
+        else:
+            with open(dest, 'w') as f:
+                print('\n'.join(lines), file=f)
+
+def run_profiled(func, args):
+    # run func(args) under the --cprofile and --tracemalloc hooks, then report --profile
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start(25)
+    if args.cprofile:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+    try:
+        return func(args)
+    finally:
+        if args.cprofile:
+            prof.disable()
+            prof.dump_stats(args.cprofile)
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(args.tracemalloc, 'w') as f:
+                print(f'peak traced memory: {peak/1024/1024:.1f} MiB, current: {current/1024/1024:.1f} MiB', file=f)
+                for stat in snapshot.statistics('lineno')[:50]:
+                    print(stat, file=f)
+        if args.profile:
+            args.profiler.report(args.profile)
+
 def is_local_bit_set(mac):
-    byte = mac.split(':')
-    return int(byte[0], 16) & 0b00000010 == 0b00000010
+    return int(mac[:2], 16) & 0b00000010 == 0b00000010
 
-def get_data(args):
-    ts = {}
+class MacClassifier(object):
+    # precompiled --mac, merged and ignored patterns, to classify each mac once
+    def __init__(self, args):
+        self.regex = None
+        if args.mac:
+            # match on start of mac address and use % as wild-card like in SQL syntax
+            patterns = ('.*'.join(re.escape(p) for p in am.lower().split('%')) for am in args.mac)
+            self.regex = re.compile('^(?:'+'|'.join(patterns)+')')
+        # merged OUI are the first 8 characters of the mac
+        self.merged = dict.fromkeys(args.merged)
+        ignored = config.IGNORED
+        if isinstance(ignored, str):
+            ignored = (ignored,)
+        self.ignored = frozenset(ignored)
+        self.knownmac = args.knownmac
+        self.privacy = args.privacy
+
+    def keep(self, mac):
+        # mac selected with --mac and not ignored
+        if mac in self.ignored:
+            return False
+        return self.regex is None or self.regex.match(mac) is not None
+
+    def group(self, mac):
+        # virtual mac this mac is merged into, or None
+        if mac[:8] in self.merged:
+            return mac[:8]
+        if self.privacy and mac not in self.knownmac and is_local_bit_set(mac):
+            return 'LAA'
+        return None
+
+def connect_db(args):
     if args.verbose:
         print(f':: Processing kismet file {args.db}')
     # sqlite3
     conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
     c = conn.cursor()
-    sql = 'pragma quick_check;'
-    try:
-        c.execute(sql)
-        res = c.fetchone()[0]
-        if res != 'ok':
-            raise sqlite3.DatabaseError()
-    except sqlite3.DatabaseError:
-        print(f'Error: {args.db} db failed integrity check')
-        sys.exit(1)
-
     sql = 'pragma query_only = on;'
     c.execute(sql)
     sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
     c.execute(sql)
-    sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
-    c.execute(sql)
+    # no journal_mode change: a read-only connection doesn't journal, and it
+    # fails on a WAL db kismet is writing
     conn.commit()
+    return conn
 
-    # use last packet ts_sec
-    #sql = 'select ts_sec from packets where phyname="IEEE802.11" order by ts_sec asc limit 1;'
-    #c.execute(sql)
-    #ts_sec_first = datetime.datetime.fromtimestamp(c.fetchone()[0])
-    sql = 'select ts_sec from packets where phyname="IEEE802.11" order by ts_sec desc limit 1;'
-    c.execute(sql)
-    res = c.fetchone()
-    if not res:
+def failed_check(args, reason):
+    print(f'Error: {args.db} db failed integrity check ({reason})', file=sys.stderr)
+    sys.exit(1)
+
+def check_header(c, args):
+    # cheap sanity check: sqlite header, page size, truncation and the schema we read
+    with open(args.db, 'rb') as f:
+        header = f.read(100)
+    if len(header) < 100 or header[:16] != SQLITE_HEADER:
+        failed_check(args, 'not a sqlite3 db')
+    page_size = int.from_bytes(header[16:18], 'big')
+    if page_size == 1:
+        page_size = 65536
+    if page_size < 512 or page_size & (page_size-1):
+        failed_check(args, f'bad page size {page_size}')
+    # the size in pages is only valid when written by the same change as the header
+    pages = int.from_bytes(header[28:32], 'big')
+    if pages and header[24:28] == header[92:96] and os.path.getsize(args.db) < pages*page_size:
+        failed_check(args, 'truncated file')
+    try:
+        for table, columns in SCHEMA.items():
+            c.execute(f'pragma table_info({table});')
+            missing = set(columns) - set(row[1] for row in c.fetchall())
+            if missing:
+                failed_check(args, f'no column {", ".join(sorted(missing))} in table {table}')
+    except sqlite3.DatabaseError as e:
+        failed_check(args, e)
+
+def get_check_key(args):
+    # a full check is only valid for this exact file
+    st = os.stat(args.db)
+    return os.path.abspath(args.db), [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def get_check_cache():
+    if config.CHECK_CACHE:
+        return config.CHECK_CACHE
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'kismet_timeplot', 'checks.json')
+
+def read_checks():
+    try:
+        with open(get_check_cache()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_check(path, key):
+    # only successful checks are remembered, dbs which vanished are forgotten
+    checks = {p:k for p,k in read_checks().items() if os.path.exists(p)}
+    checks[path] = key
+    filename = get_check_cache()
+    tmp = f'{filename}.tmp{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(checks, f)
+        os.replace(tmp, filename)
+    except OSError:
+        pass
+
+def quick_check(db, result):
+    # on its own connection, as it runs in another thread
+    try:
+        conn = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+        result.append(conn.execute('pragma quick_check;').fetchone()[0])
+        conn.close()
+    except sqlite3.DatabaseError as e:
+        result.append(str(e))
+
+def start_check(c, args):
+    # check the db at the --check level, the full check running in the
+    # background while the data is queried (see wait_check)
+    args.checking = None
+    if args.check == 'none':
+        return
+    with args.profiler.stage('check'):
+        check_header(c, args)
+    if args.check != 'full':
+        return
+    path, key = get_check_key(args)
+    if read_checks().get(path) == key:
+        if args.verbose:
+            print(f':: Skipping integrity check of unchanged {args.db}')
+        return
+    result = []
+    thread = threading.Thread(target=quick_check, args=(args.db, result), daemon=True)
+    thread.start()
+    args.checking = (thread, result, path, key)
+
+def wait_check(args):
+    # abort the run if the full check found a corruption
+    if not getattr(args, 'checking', None):
+        return
+    thread, result, path, key = args.checking
+    args.checking = None
+    with args.profiler.stage('check wait'):
+        thread.join()
+    if result != ['ok']:
+        failed_check(args, result[0] if result else 'unknown error')
+    write_check(path, key)
+
+def check_db(c, args):
+    start_check(c, args)
+    wait_check(args)
+
+def clamp_end_time(last, args):
+    if last is None:
         print('Error: no packet found', file=sys.stderr)
         sys.exit(1)
-    ts_sec_last = datetime.datetime.fromtimestamp(res[0])
+    ts_sec_last = datetime.datetime.fromtimestamp(last)
     if args.end_time > ts_sec_last:
         args.end_time = ts_sec_last
         if not args.start:
             args.start_time = args.end_time - args.time_span
 
-    sql = 'select ts_sec,ts_usec,lower(sourcemac),lower(destmac),signal,datasource from packets where phyname="IEEE802.11";'
-    c.execute(sql)
-    for row in c.fetchall():
-        if args.src and row[5] not in args.src:
-            continue
-        ts_sec = datetime.datetime.fromtimestamp(row[0])
-        ts_sec = ts_sec.replace(microsecond=row[1])
-        if ts_sec > args.end_time or ts_sec < args.start_time:
-            continue
-        if row[4] < args.rssi:
-            continue
-        if row[2] in ts:
-            ts[row[2]].append(row[0])
-        else:
-            ts[row[2]] = [row[0]]
-        if row[3] in ts:
-            ts[row[3]].append(row[0])
-        else:
-            ts[row[3]] = [row[0]]
+def open_db(args, clamp=True):
+    if args.snapshot:
+        return snapshot_db(args, clamp)
+    conn = connect_db(args)
+    c = conn.cursor()
+    start_check(c, args)
+    if not clamp:
+        return conn
+
+    # use last packet ts_sec
+    #sql = 'select ts_sec from packets where phyname="IEEE802.11" order by ts_sec asc limit 1;'
+    #c.execute(sql)
+    #ts_sec_first = datetime.datetime.fromtimestamp(c.fetchone()[0])
+    sql = 'select ts_sec from packets where phyname="IEEE802.11" order by ts_sec desc limit 1;'
+    with args.profiler.stage('last packet'):
+        c.execute(sql)
+        res = c.fetchone()
+    clamp_end_time(res[0] if res else None, args)
+    return conn
+
+def retry_busy(func, args):
+    # kismet locks the db while it commits: retry a few times, waiting longer each time
+    delay = BUSY_DELAY
+    for retry in range(BUSY_RETRIES+1):
+        try:
+            return func()
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or retry == BUSY_RETRIES:
+                raise
+        if args.verbose:
+            print(f':: {args.db} is busy, retrying in {delay:.2f}s')
+        time.sleep(delay)
+        delay *= 2
+
+def get_last_packet(c):
+    c.execute('select ts_sec from src.packets where phyname="IEEE802.11" order by ts_sec desc limit 1;')
+    res = c.fetchone()
+    return res[0] if res else None
+
+def lock_schema(c):
+    c.execute('begin;')
+    try:
+        c.execute('select count(*) from src.sqlite_master;')
+    except sqlite3.Error:
+        c.execute('rollback;')
+        raise
+
+def copy_snapshot(c, args):
+    # a single read transaction, for the packets and devices of the same point in time
+    c.execute('begin;')
+    try:
+        # whole seconds of the time window, the queries filter the rest
+        (start_sec, _), (end_sec, _) = get_window(args)
+        columns = ','.join(SCHEMA['packets'])
+        c.execute(f'insert into main.packets (rowid,{columns}) select rowid,{columns} from src.packets'
+            ' where phyname="IEEE802.11" and ts_sec between ? and ?;', (start_sec, end_sec))
+        rows = c.rowcount
+        columns = ','.join(SCHEMA['devices'])
+        c.execute(f'insert into main.devices ({columns}) select {columns} from src.devices;')
+        c.execute('commit;')
+    except sqlite3.Error:
+        c.execute('rollback;')
+        raise
+    return rows
+
+def snapshot_db(args, clamp=True):
+    # copy the packets of the time window and the devices to memory, keeping the
+    # db for one short read only: kismet can write it while we query the copy
+    if args.verbose:
+        print(f':: Taking a snapshot of kismet file {args.db}')
+    if args.check == 'full':
+        # the full check would hold the db for its whole scan
+        args.check = 'header'
+    conn = sqlite3.connect('file::memory:', uri=True, timeout=SNAPSHOT_TIMEOUT, isolation_level=None)
+    c = conn.cursor()
+    try:
+        # attaching reads the schema of the db, then keep it in a transaction for the check
+        retry_busy(lambda: c.execute('attach database ? as src;', (f'file:{args.db}?mode=ro',)), args)
+        retry_busy(lambda: lock_schema(c), args)
+        start_check(c, args)
+        # the copies hide the tables of the db from the queries
+        c.execute(f'create table main.packets ({",".join(SCHEMA["packets"])});')
+        c.execute(f'create table main.devices ({",".join(SCHEMA["devices"])});')
+        c.execute('commit;')
+        if clamp:
+            # before the snapshot, to not hold the db during this scan too
+            with args.profiler.stage('last packet'):
+                clamp_end_time(retry_busy(lambda: get_last_packet(c), args), args)
+        tick = time.perf_counter()
+        with args.profiler.stage('snapshot') as st:
+            rows = retry_busy(lambda: copy_snapshot(c, args), args)
+            st['rows_out'] = rows
+    except sqlite3.OperationalError as e:
+        print(f'Error: no snapshot of {args.db} ({e})', file=sys.stderr)
+        sys.exit(-1)
+    c.execute('detach database src;')
+    if args.verbose:
+        print(f':: Snapshot of {rows} packets in {time.perf_counter()-tick:.2f}s')
+    return conn
+
+def get_window(args):
+    # time window as integer (ts_sec, ts_usec) pairs
+    start = args.start_time.timestamp()
+    end = args.end_time.timestamp()
+    return (int(start), round((start % 1)*1000000)), (int(end), round((end % 1)*1000000))
+
+def packets_where(args):
+    # time window, rssi and datasource filters of the packets, comparing
+    # integer (ts_sec, ts_usec) pairs instead of building a datetime per row
+    (start_sec, start_usec), (end_sec, end_usec) = get_window(args)
+    sql = 'phyname="IEEE802.11"'
+    sql += ' and (ts_sec > ? or (ts_sec = ? and ts_usec >= ?)) and (ts_sec < ? or (ts_sec = ? and ts_usec <= ?))'
+    # redundant bounds, for sqlite to use a range of an index on ts_sec
+    sql += ' and ts_sec between ? and ?'
+    sql += ' and signal >= ?'
+    sql_args = [start_sec, start_sec, start_usec, end_sec, end_sec, end_usec, start_sec, end_sec, args.rssi]
+    if args.src:
+        sql += ' and datasource in ('+','.join(['?']*len(args.src))+')'
+        sql_args.extend(args.src)
+    return sql, sql_args
 
-    # filter to keep only wifi client and device
+def select_packets(c, args, rowids=None):
+    # push time window, rssi and datasource filters down to sqlite
+    where, sql_args = packets_where(args)
+    sql = 'select ts_sec,lower(sourcemac),lower(destmac) from packets where '+where
+    if rowids is not None:
+        # only packets in ]lo, hi]
+        sql += ' and rowid > ? and rowid <= ? order by rowid'
+        sql_args.extend(rowids)
+    c.execute(sql, sql_args)
+
+def report_kept(c, kept, args):
+    if args.verbose:
+        # max(rowid) is cheap and a good estimate of the number of rows in the table
+        c.execute('select max(rowid) from packets;')
+        total = c.fetchone()[0] or 0
+        print(f':: Kept {kept} rows out of ~{total} scanned in the packets table')
+
+def get_dev_type(c, since=None):
     sql = 'select lower(devmac),type from devices'
-    c.execute(sql)
+    if since is None:
+        c.execute(sql)
+    else:
+        # only devices updated since the previous call
+        c.execute(sql+' where last_time >= ?', (since,))
     dev_type = {}
     for row in c.fetchall():
         dev_type[row[0]] = row[1]
-    conn.close()
+    return dev_type
 
+def get_keepthem(args):
     if args.no_devices:
         keepthem = tuple()
     else:
@@ -113,71 +495,873 @@ def get_data(args):
         keepthem += ('Wi-Fi AP',)
     if args.bridged:
         keepthem += ('Wi-Fi Bridged',)
-    for k in list(ts.keys()):
-        # remove Wi-Fi AP and Wi-Fi-Bridged
-        if k not in dev_type or dev_type[k] not in keepthem:
-            del ts[k]
-
-    def match(m, s):
-        # match on start of mac address and use % as wild-card like in SQL syntax
-        if '%' in m:
-            m = m.replace('%', '.*')
-        else:
-            m = m+'.*'
-        m = '^'+m
-        return re.search(m, s) is not None
+    return keepthem
 
-    macs = list(ts.keys())
-    if args.mac :
-        # keep mac with args.mac as substring
-        macs = [m for m in macs if any(match(am.lower(), m) for am in args.mac)]
+def get_data(args):
+    if len(args.dbs) > 1:
+        return get_data_multi(args)
+    if args.parallel > 1 and not args.cache and not args.sql:
+        return get_data_ranges(args)
+
+    if args.cache:
+        data = get_columns(args)
+        chunks = filter_columns(data, args)
+        if args.verbose:
+            print(f':: Kept {len(chunks[0][0])} rows out of {len(data["ts_sec"])} in the cache')
+        macs, times = group_lanes(chunks, data['macs'], data['dev_type'], args)
+        return merge_macs(macs, times, args)
+
+    if args.numpy:
+        macs, times = group_lanes(*load_db(args, clamp=True), args)
+        return merge_macs(macs, times, args)
+
+    ts, dev_type = load_db(args, clamp=True)
+    macs, times = filter_lanes(ts, dev_type, args)
+    return merge_macs(macs, times, args)
+
+class Timelines(dict):
+    # timestamps of each mac in a typed array (8 bytes per packet instead of a
+    # list slot and an int object), down-sampled when over limit timestamps:
+    # dropped keeps the number of packets removed from each mac
+    __slots__ = ('dropped', 'limit', 'size', 'step')
+
+    def __init__(self, limit=None):
+        super().__init__()
+        self.dropped = {}
+        self.limit = limit
+        # upper bound of the number of timestamps
+        self.size = 0
+        self.step = 1
+
+    def count(self, mac):
+        # real number of packets of mac
+        return len(self[mac]) + self.dropped.get(mac, 0)
+
+    def merge(self, other):
+        # append the timelines of a later db
+        for k,v in other.items():
+            if k in self:
+                self[k].extend(v)
+            else:
+                self[k] = v
+        for k,n in other.dropped.items():
+            self.dropped[k] = self.dropped.get(k, 0) + n
+        self.size += other.size
+
+    def shrink(self):
+        # keep one packet per step seconds in the timelines with more than one,
+        # doubling step until we fit in the limit (largest timelines shrink most)
+        self.size = sum(len(v) for v in self.values())
+        while self.size > self.limit and self.step < NUMOFSECSINADAY:
+            self.step *= 2
+            for k,v in self.items():
+                a = np.frombuffer(v, dtype=np.int64)
+                q = a // self.step
+                keep = np.concatenate(([True], q[1:] != q[:-1]))
+                if keep.all():
+                    continue
+                lane = array.array('q')
+                lane.frombytes(a[keep].tobytes())
+                self.dropped[k] = self.dropped.get(k, 0) + len(v)-len(lane)
+                self.size -= len(v)-len(lane)
+                self[k] = lane
+
+def load_lists(c, args):
+    # devices first, to only keep the macs which can pass the type and --mac filters
+    with args.profiler.stage('devices') as st:
+        dev_type = get_dev_type(c)
+        st['rows_out'] = len(dev_type)
+    keepthem = get_keepthem(args)
+    classifier = MacClassifier(args)
+    dropped = set()
+    limit = args.max_memory*1024*1024//8 if args.max_memory else None
+    ts = Timelines(limit)
+    with args.profiler.stage('query') as st:
+        select_packets(c, args, args.rowids)
+        kept = 0
+        while True:
+            rows = c.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            kept += len(rows)
+            for ts_sec, src, dst in rows:
+                if src in ts:
+                    ts[src].append(ts_sec)
+                elif src not in dropped:
+                    if dev_type.get(src) in keepthem and classifier.keep(src):
+                        ts[src] = array.array('q', (ts_sec,))
+                    else:
+                        dropped.add(src)
+                if dst in ts:
+                    ts[dst].append(ts_sec)
+                elif dst not in dropped:
+                    if dev_type.get(dst) in keepthem and classifier.keep(dst):
+                        ts[dst] = array.array('q', (ts_sec,))
+                    else:
+                        dropped.add(dst)
+            ts.size += 2*len(rows)
+            if limit and ts.size > limit:
+                ts.shrink()
+        st.update(rows_out=kept, macs_out=len(ts))
+    report_kept(c, kept, args)
+    if args.verbose and ts.step > 1:
+        print(f':: Down-sampled timelines to one packet every {ts.step}s to stay under {args.max_memory} MiB')
+    return ts, dev_type
+
+def filter_lanes(ts, dev_type, args):
+    # number of packets of each mac, even when its timeline has been down-sampled
+    if isinstance(ts, Timelines):
+        count = ts.count
+    else:
+        count = lambda k: len(ts[k])
+    # work on a copy, to leave the timelines of follow mode untouched
+    ts = dict(ts)
+    with args.profiler.stage('filter type') as st:
+        st.update(macs_in=len(ts))
+        keepthem = get_keepthem(args)
+        for k in list(ts.keys()):
+            # remove Wi-Fi AP and Wi-Fi-Bridged
+            if k not in dev_type or dev_type[k] not in keepthem:
+                del ts[k]
+        st.update(macs_out=len(ts))
 
     # filter our data set based on min probe request or mac appearence
-    for k,v in list(ts.items()):
-        if (len(v) <= args.min and k not in args.knownmac) or k not in macs or k in config.IGNORED:
-            del ts[k]
+    with args.profiler.stage('filter mac') as st:
+        st.update(macs_in=len(ts))
+        classifier = MacClassifier(args)
+        for k in list(ts.keys()):
+            if (count(k) <= args.min and k not in args.knownmac) or not classifier.keep(k):
+                del ts[k]
+        st.update(macs_out=len(ts))
 
     # sort the data on frequency of appearence
-    data = sorted(list(ts.items()), key=lambda x:len(x[1]))
-    data.reverse()
-    macs = [x for x,_ in data]
-    times = [x for _,x in data]
+    with args.profiler.stage('sort'):
+        data = sorted(list(ts.items()), key=lambda x:count(x[0]))
+        data.reverse()
+        macs = [x for x,_ in data]
+        times = [x for _,x in data]
+    return macs, times
+
+def load_sql(c, args):
+    # let sqlite join the packets to the type of their device and count them
+    # per mac, then only fetch the timestamps of the macs which will be plotted.
+    # kismet writes macs upper case in both tables: they are compared as they
+    # are, lower() on each row would defeat the indexes of --build-index
+    where, where_args = packets_where(args)
+    keepthem = get_keepthem(args)
+    # count the packets of each mac before joining them to their device
+    sql = 'select p.mac,d.type from (select mac,count(*) as n from (select sourcemac as mac from packets where '+where
+    sql += ' union all select destmac from packets where '+where+') group by mac) p'
+    sql += ' join devices d on d.phyname = "IEEE802.11" and d.devmac = p.mac'
+    sql += ' where d.type in ('+','.join(['?']*len(keepthem))+')'
+    sql_args = where_args + where_args + list(keepthem)
+    if len(args.dbs) == 1:
+        # with several dbs, --min applies to the merged timelines (in filter_lanes)
+        knownmac = (args.knownmac,) if isinstance(args.knownmac, str) else args.knownmac
+        sql += ' and (p.n > ? or p.mac in (select value from json_each(?)))'
+        sql_args += [args.min, json.dumps([m for mac in knownmac for m in (mac.upper(), mac)])]
+    classifier = MacClassifier(args)
+    names = {}
+    dev_type = {}
+    with args.profiler.stage('devices') as st:
+        c.execute(sql, sql_args)
+        for mac, dev in c.fetchall():
+            m = mac.lower()
+            if classifier.keep(m):
+                names[mac] = m
+                dev_type[m] = dev
+        st['rows_out'] = len(names)
+    if args.verbose:
+        print(f':: Selected {len(names)} macs in the db')
+
+    limit = args.max_memory*1024*1024//8 if args.max_memory else None
+    ts = Timelines(limit)
+    with args.profiler.stage('query') as st:
+        macs = json.dumps(list(names))
+        sql = 'select ts_sec,sourcemac,destmac from packets where '+where
+        sql += ' and (sourcemac in (select value from json_each(?)) or destmac in (select value from json_each(?)))'
+        # in time order, like a scan of the table (and free with the index)
+        sql += ' order by ts_sec,ts_usec'
+        c.execute(sql, where_args+[macs, macs])
+        kept = 0
+        while True:
+            rows = c.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            kept += len(rows)
+            for ts_sec, src, dst in rows:
+                src = names.get(src)
+                if src in ts:
+                    ts[src].append(ts_sec)
+                elif src is not None:
+                    ts[src] = array.array('q', (ts_sec,))
+                dst = names.get(dst)
+                if dst in ts:
+                    ts[dst].append(ts_sec)
+                elif dst is not None:
+                    ts[dst] = array.array('q', (ts_sec,))
+            ts.size += 2*len(rows)
+            if limit and ts.size > limit:
+                ts.shrink()
+        st.update(rows_out=kept, macs_out=len(ts))
+    report_kept(c, kept, args)
+    if args.verbose and ts.step > 1:
+        print(f':: Down-sampled timelines to one packet every {ts.step}s to stay under {args.max_memory} MiB')
+    return ts, dev_type
+
+def build_index(args):
+    # one-time writable copy of the db with the covering indexes of --sql
+    if os.path.exists(args.build_index):
+        print(f'Error: {args.build_index} already exists', file=sys.stderr)
+        sys.exit(-1)
+    if args.verbose:
+        print(f':: Copying {args.db} to {args.build_index}')
+    src = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    dst = sqlite3.connect(args.build_index)
+    try:
+        src.backup(dst)
+        for sql in INDEXES:
+            if args.verbose:
+                print(f':: {sql}')
+            dst.execute(sql)
+        # statistics for the query planner to pick the indexes
+        dst.execute('analyze;')
+        dst.commit()
+    except sqlite3.DatabaseError as e:
+        failed_check(args, e)
+    finally:
+        src.close()
+        dst.close()
+
+def load_numpy(c, args):
+    # columnar engine: timestamps and integer mac codes of the packets in
+    # chunks of typed arrays, 16 bytes per packet. Devices first, like the
+    # list engine: the macs which can't pass the type and --mac filters share
+    # the code of None, and the packets between two of them are not kept
+    with args.profiler.stage('devices') as st:
+        dev_type = get_dev_type(c)
+        st['rows_out'] = len(dev_type)
+    keepthem = get_keepthem(args)
+    classifier = MacClassifier(args)
+    codes = {}
+    names = []
+    def new_code(m):
+        if dev_type.get(m) in keepthem and classifier.keep(m):
+            names.append(m)
+            codes[m] = len(names)-1
+        elif None in codes:
+            codes[m] = codes[None]
+        else:
+            names.append(None)
+            codes[m] = codes[None] = len(names)-1
+        return codes[m]
+    chunks = []
+    chunk = new_chunk()
+    filled = 0
+    with args.profiler.stage('query') as st:
+        select_packets(c, args, args.rowids)
+        kept = 0
+        while True:
+            rows = c.fetchmany(BATCH_SIZE)
+            if rows:
+                n = len(rows)
+                kept += n
+                t = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+                src = np.fromiter((codes[r[1]] if r[1] in codes else new_code(r[1]) for r in rows), dtype=np.int32, count=n)
+                dst = np.fromiter((codes[r[2]] if r[2] in codes else new_code(r[2]) for r in rows), dtype=np.int32, count=n)
+                if None in codes:
+                    mask = (src != codes[None]) | (dst != codes[None])
+                    t, src, dst = t[mask], src[mask], dst[mask]
+            if filled and (not rows or filled+len(t) > SORT_CHUNK):
+                chunks.append(tuple(col[:filled] for col in chunk))
+                chunk = new_chunk()
+                filled = 0
+            if not rows:
+                break
+            for col, v in zip(chunk, (t, src, dst)):
+                col[filled:filled+len(t)] = v
+            filled += len(t)
+        st.update(rows_out=kept, macs_out=len(names))
+    report_kept(c, kept, args)
+    return chunks, names, dev_type
+
+def new_chunk():
+    # columns of SORT_CHUNK packets in anonymous memory, committed as they are
+    # filled and given back to the system as soon as the chunk is freed
+    return tuple(np.frombuffer(mmap.mmap(-1, SORT_CHUNK*np.dtype(d).itemsize), dtype=d) for d in (np.int64, np.int32, np.int32))
+
+def group_lanes(chunks, names, dev_type, args):
+    with args.profiler.stage('filter mac') as st:
+        st.update(rows_in=sum(len(t) for t,_,_ in chunks), macs_in=len(names))
+        # decide once per mac (not per packet) which ones to keep
+        keepthem = get_keepthem(args)
+        classifier = MacClassifier(args)
+        keep = np.fromiter((m is not None and dev_type.get(m) in keepthem and classifier.keep(m) for m in names), dtype=bool, count=len(names))
+        counts = np.zeros(len(names), dtype=np.int64)
+        for _, src, dst in chunks:
+            counts += np.bincount(src, minlength=len(names)) + np.bincount(dst, minlength=len(names))
+        known = np.fromiter((m is not None and m in args.knownmac for m in names), dtype=bool, count=len(names))
+        keep &= ((counts > args.min) | known) & (counts > 0)
+        st.update(macs_out=int(keep.sum()))
+
+    with args.profiler.stage('sort') as st:
+        macs, times = sort_lanes(chunks, names, counts, keep)
+        st['rows_out'] = sum(len(t) for t in times)
+    return macs, times
+
+def iter_slices(chunks):
+    # the chunks in slices of at most SORT_CHUNK packets, with their codes in
+    # scan order (source before destination)
+    for t, src, dst in chunks:
+        for lo in range(0, len(t), SORT_CHUNK):
+            yield t[lo:lo+SORT_CHUNK], np.stack((src[lo:lo+SORT_CHUNK], dst[lo:lo+SORT_CHUNK]), axis=1).ravel()
+
+def sort_lanes(chunks, names, counts, keep):
+    # counting sort of the timestamps of the kept macs into a single array,
+    # split in one lane per mac: the sizes of the lanes are known from counts,
+    # so each slice of packets is written at the current offsets of its macs,
+    # and the chunks are freed as they are sorted
+
+    # first appearance of each mac, to break ties like the list engine does
+    end = 2*sum(len(t) for t,_,_ in chunks)
+    first = np.full(len(names), end, dtype=np.int64)
+    base = 0
+    for _, codes in iter_slices(chunks):
+        if (first[keep] < end).all():
+            break
+        uniq, indx = np.unique(codes, return_index=True)
+        first[uniq] = np.minimum(first[uniq], base+indx)
+        base += len(codes)
+
+    # sort on frequency of appearence, most frequent first
+    order = np.flatnonzero(keep)
+    order = order[np.lexsort((first[order], counts[order]))[::-1]]
+    sizes = counts[order]
+    ends = np.cumsum(sizes)
+    cursor = np.zeros(len(names), dtype=np.int64)
+    cursor[order] = ends - sizes
+    if not len(order):
+        return [], []
+    # anonymous memory committed page by page as the lanes fill, while the
+    # chunks are freed (numpy backs large arrays with huge pages, which the
+    # first writes to each lane would commit all at once)
+    out = np.frombuffer(mmap.mmap(-1, 8*int(ends[-1])), dtype=np.int64)
+    while chunks:
+        for t, codes in iter_slices([chunks.pop(0)]):
+            t = np.repeat(t, 2)
+            mask = keep[codes]
+            codes = codes[mask]
+            t = t[mask]
+            # stable within the slice, and the rank of each packet among those of its mac
+            o = np.argsort(codes, kind='stable')
+            codes = codes[o]
+            rank = np.arange(len(codes)) - np.searchsorted(codes, codes)
+            out[cursor[codes] + rank] = t[o]
+            cursor += np.bincount(codes, minlength=len(names))
+    return [names[i] for i in order], np.split(out, ends[:-1])
+
+def cache_key(c, args):
+    # a cache entry is only valid for this exact file content
+    st = os.stat(args.db)
+    c.execute('select max(rowid) from packets;')
+    rowid = c.fetchone()[0] or 0
+    path = os.path.abspath(args.db)
+    key = hashlib.sha1(f'{path}:{st.st_size}:{st.st_mtime_ns}:{rowid}'.encode()).hexdigest()
+    return path, key, rowid
+
+def get_cache_dir(args):
+    if args.cache_dir:
+        return args.cache_dir
+    if config.CACHE_DIR:
+        return config.CACHE_DIR
+    # default to a directory next to the db
+    return os.path.join(os.path.dirname(os.path.abspath(args.db)), CACHE_DIRNAME)
+
+def load_cache(entry):
+    with open(os.path.join(entry, 'meta.json')) as f:
+        data = json.load(f)
+    for col in CACHE_COLUMNS:
+        data[col] = np.load(os.path.join(entry, f'{col}.npy'), mmap_mode='r')
+    # mark the entry as recently used for eviction
+    os.utime(os.path.join(entry, 'meta.json'))
+    return data
+
+def build_cache(c, path, rowid):
+    # extract the whole IEEE802.11 packets table up to rowid, leaving only cheap filters for later runs
+    data = {col:np.empty(0, dtype=CACHE_DTYPES[col]) for col in CACHE_COLUMNS}
+    data.update(path=path, macs=[], datasources=[], last=None, rowid=0)
+    return extend_columns(c, data, rowid)
+
+def extend_columns(c, data, rowid):
+    # append the packets in ]data['rowid'], rowid] to the columns, the new macs
+    # and datasources being coded after the known ones
+    macs = {m:i for i,m in enumerate(data['macs'])}
+    srcs = {s:i for i,s in enumerate(data['datasources'])}
+    chunks = {col:[data[col]] for col in CACHE_COLUMNS}
+    sql = 'select ts_sec,ts_usec,lower(sourcemac),lower(destmac),ifnull(signal,?),datasource from packets where phyname="IEEE802.11" and rowid > ? and rowid <= ?;'
+    c.execute(sql, (NOSIGNAL, data['rowid'], rowid))
+    while True:
+        rows = c.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        n = len(rows)
+        chunks['ts_sec'].append(np.fromiter((r[0] for r in rows), dtype=np.int64, count=n))
+        chunks['ts_usec'].append(np.fromiter((r[1] for r in rows), dtype=np.int32, count=n))
+        # code macs in scan order, source before destination
+        codes = np.fromiter((macs.setdefault(m, len(macs)) for r in rows for m in (r[2], r[3])), dtype=np.int32, count=2*n).reshape(n, 2)
+        chunks['src'].append(codes[:,0].copy())
+        chunks['dst'].append(codes[:,1].copy())
+        chunks['signal'].append(np.fromiter((r[4] for r in rows), dtype=np.int16, count=n))
+        chunks['datasource'].append(np.fromiter((srcs.setdefault(r[5], len(srcs)) for r in rows), dtype=np.int16, count=n))
+    lasts = [int(t.max()) for t in chunks['ts_sec'][1:]]
+    if data['last'] is not None:
+        lasts.append(data['last'])
+    path = data['path']
+    # the known columns are only copied when packets are appended
+    data = {col:np.concatenate(chunks[col]) if len(chunks[col]) > 1 else data[col] for col in CACHE_COLUMNS}
+    del chunks
+    data['path'] = path
+    data['macs'] = list(macs.keys())
+    data['datasources'] = list(srcs.keys())
+    data['dev_type'] = get_dev_type(c)
+    data['last'] = max(lasts, default=None)
+    data['rowid'] = rowid
+    return data
+
+def write_cache(data, entry, args):
+    # write in a temporary directory and rename it, so a partial entry is never read
+    tmp = f'{entry}.tmp{os.getpid()}'
+    try:
+        os.makedirs(tmp)
+        for col in CACHE_COLUMNS:
+            np.save(os.path.join(tmp, f'{col}.npy'), data[col])
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({k:v for k,v in data.items() if k not in CACHE_COLUMNS}, f)
+        os.rename(tmp, entry)
+    except OSError as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if args.verbose:
+            print(f':: Could not write cache {entry}: {e}')
+
+def evict_cache(cache_dir, path, keep):
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta = os.path.join(entry, 'meta.json')
+        if entry == keep or not os.path.exists(meta):
+            continue
+        try:
+            with open(meta) as f:
+                stale = json.load(f)['path'] == path
+        except (OSError, ValueError, KeyError):
+            stale = True
+        if stale:
+            # older extraction of the same db: never served again
+            shutil.rmtree(entry, ignore_errors=True)
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(meta), size, entry))
+        total += size
+    if os.path.isdir(keep):
+        total += sum(os.path.getsize(os.path.join(keep, f)) for f in os.listdir(keep))
+    # remove least recently used entries until we fit in config.CACHE_SIZE
+    for _, size, entry in sorted(entries):
+        if total <= config.CACHE_SIZE:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def get_columns(args, clamp=True):
+    conn = connect_db(args)
+    c = conn.cursor()
+    path, key, rowid = cache_key(c, args)
+    cache_dir = get_cache_dir(args)
+    entry = os.path.join(cache_dir, key)
+    data = None
+    if args.cache and os.path.exists(os.path.join(entry, 'meta.json')):
+        try:
+            with args.profiler.stage('cache load') as st:
+                data = load_cache(entry)
+                # the packets of an entry are the ones up to the rowid of its key
+                data['rowid'] = rowid
+                st['rows_out'] = len(data['ts_sec'])
+            if args.verbose:
+                print(f':: Using cache {entry}')
+        except (OSError, ValueError):
+            data = None
+    if data is None:
+        # only check the db when (re)building the cache, as it is unchanged otherwise
+        start_check(c, args)
+        try:
+            with args.profiler.stage('cache build') as st:
+                data = build_cache(c, path, rowid)
+                st.update(rows_out=len(data['ts_sec']), macs_out=len(data['macs']))
+        except sqlite3.DatabaseError as e:
+            failed_check(args, e)
+        wait_check(args)
+        # without --cache (batch mode), the columns are only kept in memory
+        if args.cache:
+            if args.verbose:
+                print(f':: Building cache {entry}')
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError:
+                pass
+            write_cache(data, entry, args)
+            if os.path.isdir(cache_dir):
+                evict_cache(cache_dir, path, entry)
+    conn.close()
+    if clamp:
+        clamp_end_time(data['last'], args)
+    return data
+
+def update_columns(data, args, rowid):
+    # append the packets written since the columns were loaded, up to rowid: the
+    # db changes all the time, so only its header is checked
+    conn = connect_db(args)
+    c = conn.cursor()
+    if args.check == 'full':
+        args = copy.copy(args)
+        args.check = 'header'
+    start_check(c, args)
+    try:
+        with args.profiler.stage('cache update') as st:
+            rows = len(data['ts_sec'])
+            data = extend_columns(c, data, rowid)
+            st.update(rows_out=len(data['ts_sec'])-rows, macs_out=len(data['macs']))
+    except sqlite3.DatabaseError as e:
+        failed_check(args, e)
+    conn.close()
+    return data
+
+def filter_columns(data, args):
+    # apply time window, rssi and datasource filters on the cached columns
+    (start_sec, start_usec), (end_sec, end_usec) = get_window(args)
+    ts_sec = data['ts_sec']
+    ts_usec = data['ts_usec']
+    with args.profiler.stage('filter window') as st:
+        mask = ((ts_sec > start_sec) | ((ts_sec == start_sec) & (ts_usec >= start_usec)))
+        mask &= ((ts_sec < end_sec) | ((ts_sec == end_sec) & (ts_usec <= end_usec)))
+        mask &= data['signal'] >= args.rssi
+        if args.src:
+            codes = [i for i,s in enumerate(data['datasources']) if s in args.src]
+            mask &= np.isin(data['datasource'], codes)
+        t = ts_sec[mask]
+        st.update(rows_in=len(ts_sec), rows_out=len(t))
+    # a single chunk of the numpy engine
+    return [(t, data['src'][mask], data['dst'][mask])]
+
+def expand_dbs(dbs):
+    # expand glob patterns given to --db
+    files = []
+    for db in dbs:
+        if any(c in db for c in '*?['):
+            files.extend(sorted(glob.glob(db)))
+        else:
+            files.append(db)
+    return files
+
+def get_db_range(db):
+    # first and last packet time, kismet writing packets in time order
+    conn = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+    c = conn.cursor()
+    c.execute('select ts_sec from packets order by rowid asc limit 1;')
+    first = c.fetchone()
+    c.execute('select ts_sec from packets order by rowid desc limit 1;')
+    last = c.fetchone()
+    conn.close()
+    if first is None:
+        return db, None, None
+    return db, first[0], last[0]
+
+def select_dbs(args):
+    # only keep the dbs whose packets can overlap the time window
+    ranges = sorted((r for r in map(get_db_range, args.dbs) if r[1] is not None), key=lambda r:r[1])
+    clamp_end_time(max((r[2] for r in ranges), default=None), args)
+    (start_sec, _), (end_sec, _) = get_window(args)
+    dbs = [db for db,first,last in ranges if last >= start_sec and first <= end_sec]
+    if args.verbose:
+        print(f':: Using {len(dbs)} out of {len(args.dbs)} kismet files')
+    return dbs
+
+def call_db(job):
+    # a worker exiting would leave the pool waiting for its result forever
+    func, args = job
+    try:
+        return False, func(args)
+    except SystemExit as e:
+        return True, e.code
+
+def map_dbs(func, dbs, args):
+    # run func on each db in a pool of processes, with its own copy of args
+    jobs = []
+    for db in dbs:
+        a = copy.copy(args)
+        a.db = db
+        jobs.append(a)
+    return map_jobs(func, jobs, args)
+
+def map_jobs(func, jobs, args):
+    # run func on each of the args of jobs in a pool of processes, results in order
+    if len(jobs) <= 1:
+        return [func(a) for a in jobs]
+    with multiprocessing.Pool(min(len(jobs), args.jobs)) as pool:
+        results = pool.map(call_db, [(func, a) for a in jobs])
+    for exited, res in results:
+        if exited:
+            sys.exit(res)
+    return [res for _, res in results]
+
+def load_db(args, clamp=False):
+    # extract the packets of one db, before any per mac filtering
+    if args.cache:
+        data = get_columns(args, clamp)
+        return filter_columns(data, args), data['macs'], data['dev_type']
+    try:
+        conn = open_db(args, clamp)
+        c = conn.cursor()
+        if args.numpy:
+            res = load_numpy(c, args)
+        elif args.sql:
+            res = load_sql(c, args)
+        else:
+            res = load_lists(c, args)
+        conn.close()
+    except sqlite3.DatabaseError as e:
+        # corruption met before the background check found it
+        failed_check(args, e)
+    wait_check(args)
+    return res
 
+def merge_columns(parts):
+    # chain the (chunks, names, dev_type) of several dbs, freeing the parts as
+    # their codes are mapped
+    if len(parts) == 1:
+        return parts[0]
+    codes = {}
+    chunks = []
+    dev_type = {}
+    while parts:
+        part, names, d = parts.pop(0)
+        # map the codes of each db to global ones
+        remap = np.fromiter((codes.setdefault(m, len(codes)) for m in names), dtype=np.int32, count=len(names))
+        chunks.extend((t, remap[src], remap[dst]) for t,src,dst in part)
+        dev_type.update(d)
+    return chunks, list(codes.keys()), dev_type
+
+def get_data_columns(datas, args):
+    # timelines from the already loaded columns of one or several dbs (batch mode)
+    parts = []
+    for data in datas:
+        parts.append((filter_columns(data, args), data['macs'], data['dev_type']))
+    macs, times = group_lanes(*merge_columns(parts), args)
+    return merge_macs(macs, times, args)
+
+def get_data_multi(args):
+    # the stages run in the pool are not reported, only the whole load
+    dbs = select_dbs(args)
+    a = args
+    if args.max_memory and len(dbs) > 1:
+        # the timelines of all the dbs are merged: each db gets its share of the cap
+        a = copy.copy(args)
+        a.max_memory = args.max_memory/len(dbs)
+    with args.profiler.stage('load dbs') as st:
+        parts = map_dbs(load_db, dbs, a)
+        st['rows_out'] = sum(sum(len(t) for t,_,_ in p[0]) if args.cache or args.numpy else p[0].size//2 for p in parts)
+    # merge in time order, the dbs being sorted on their first packet
+    return merge_parts(parts, args)
+
+def get_rowid_ranges(c, args):
+    # split the rowids of the packets passing the filters in args.parallel
+    # ranges ]lo, hi], the matching packets being spread over the whole table
+    where, sql_args = packets_where(args)
+    c.execute('select min(rowid),max(rowid) from packets where '+where, sql_args)
+    lo, hi = c.fetchone()
+    if lo is None:
+        return []
+    lo -= 1
+    bounds = [lo + (hi-lo)*i//args.parallel for i in range(args.parallel+1)]
+    return [(a, b) for a,b in zip(bounds, bounds[1:]) if b > a]
+
+def get_data_ranges(args):
+    # scan rowid ranges of a single db in a pool of processes, each with its
+    # own connection, and merge their partial timelines in rowid order
+    conn = open_db(args)
+    c = conn.cursor()
+    with args.profiler.stage('ranges'):
+        ranges = get_rowid_ranges(c, args)
+    conn.close()
+    jobs = []
+    for r in ranges:
+        a = copy.copy(args)
+        a.rowids = r
+        # the db is checked here, once
+        a.check = 'none'
+        a.checking = None
+        if args.max_memory:
+            a.max_memory = args.max_memory/len(ranges)
+        jobs.append(a)
+    if args.verbose:
+        print(f':: Scanning {len(jobs)} rowid ranges in parallel')
+    with args.profiler.stage('load ranges') as st:
+        parts = map_jobs(load_db, jobs, args)
+        st['rows_out'] = sum(sum(len(t) for t,_,_ in p[0]) if args.numpy else p[0].size//2 for p in parts)
+    wait_check(args)
+    if not parts:
+        # no packet in the time window
+        return [], []
+    return merge_parts(parts, args)
+
+def merge_parts(parts, args):
+    # merge the results of load_db on several dbs or rowid ranges, in order
+    if args.cache or args.numpy:
+        macs, times = group_lanes(*merge_columns(parts), args)
+    else:
+        dev_type = {}
+        ts = Timelines()
+        for t, d in parts:
+            ts.merge(t)
+            dev_type.update(d)
+        macs, times = filter_lanes(ts, dev_type, args)
+    return merge_macs(macs, times, args)
+
+def concat_sorted(lanes):
+    # lanes are (almost) sorted already, and timsort merges such runs in
+    # O(n log k) like a k-way merge would
+    if lanes and isinstance(lanes[0], np.ndarray):
+        return np.sort(np.concatenate(lanes), kind='stable')
+    t = []
+    for l in lanes:
+        t.extend(l)
+    t.sort()
+    return t
+
+def merge_macs(macs, times, args):
     # merge all same vendor mac into one plot for a virtual MAC called 'OUI'
-    for mv in args.merged:
-        indx = [i for i,m in enumerate(macs) if m[:8] == mv]
-        if len(indx) > 0:
-            t = []
-            # merge all times for vendor macs
-            for i in indx:
-                t.extend(times[i])
-            macs = [m for i,m in enumerate(macs) if i not in indx]
-            times = [x for i,x in enumerate(times) if i not in indx]
-            macs.append(mv)
-            times.append(sorted(t))
-
-    # merge all LAA mac into one plot for a virtual MAC called 'LAA'
-    if args.privacy:
-        indx = [i for i,m in enumerate(macs) if m[:8] not in args.merged and is_local_bit_set(m) and m not in args.knownmac]
-        if len(indx) > 0:
-            t = []
-            # merge all times for LAA macs
-            for i in indx:
-                t.extend(times[i])
-            macs = [m for i,m in enumerate(macs) if i not in indx]
-            times = [x for i,x in enumerate(times) if i not in indx]
-            macs.append('LAA')
-            times.append(sorted(t))
-
-    return (macs, times)
-
-def plot_data(macs, times, args):
-    fig, ax = plt.subplots()
-    # change margin around axis to the border
-    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.07)
-    # set our custom color cycler (without red and gray)
-    ax.set_prop_cycle(cycler('color', COLORS))
+    # and all LAA mac into one plot for a virtual MAC called 'LAA', in a
+    # single pass over the macs
+    with args.profiler.stage('merge') as st:
+        st['macs_in'] = len(macs)
+        classifier = MacClassifier(args)
+        groups = {mv:[] for mv in classifier.merged}
+        groups['LAA'] = []
+        merged_macs = []
+        merged_times = []
+        for m,t in zip(macs, times):
+            g = classifier.group(m)
+            if g is None:
+                merged_macs.append(m)
+                merged_times.append(t)
+            else:
+                groups[g].append(t)
+        # virtual macs go at the end, in the order of args.merged then LAA
+        for g,lanes in groups.items():
+            if len(lanes) > 0:
+                merged_macs.append(g)
+                merged_times.append(concat_sorted(lanes))
+        st['macs_out'] = len(merged_macs)
+    return (merged_macs, merged_times)
 
+def follow(args):
+    # incremental mode for a db still being written: only query the packets
+    # added since the previous tick, and drop the ones out of the time window
+    conn = open_db(args)
+    c = conn.cursor()
+    ts = {}
+    dev_type = {}
+    watermark = 0
+    dev_watermark = None
+    fig = None
+    load_matplotlib(args)
+    if not args.image:
+        plt.ion()
+    while True:
+        tick = time.monotonic()
+        c.execute('select rowid,ts_sec from packets order by rowid desc limit 1;')
+        hi, last = c.fetchone() or (0, None)
+        if args.start:
+            # undo the clamp of the previous tick
+            args.end_time = args.start_time + args.time_span
+        else:
+            # slide the window
+            args.end_time = datetime.datetime.now()
+            args.start_time = args.end_time - args.time_span
+        end_time = args.end_time
+        clamp_end_time(last, args)
+
+        # the clamped end is the whole second of the last packet and would skip
+        # the packets after it in that second for good: the rowids already bound
+        # the new packets, so only the unclamped end filters them
+        clamped, args.end_time = args.end_time, end_time
+        select_packets(c, args, rowids=(watermark, hi))
+        args.end_time = clamped
+        kept = 0
+        while True:
+            rows = c.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            kept += len(rows)
+            for ts_sec, src, dst in rows:
+                if src in ts:
+                    ts[src].append(ts_sec)
+                else:
+                    ts[src] = collections.deque((ts_sec,))
+                if dst in ts:
+                    ts[dst].append(ts_sec)
+                else:
+                    ts[dst] = collections.deque((ts_sec,))
+        watermark = hi
+
+        # drop packets that slid out of the time window (packets are appended in time order)
+        start_sec = get_window(args)[0][0]
+        dropped = 0
+        for k in list(ts.keys()):
+            v = ts[k]
+            while v and v[0] < start_sec:
+                v.popleft()
+                dropped += 1
+            if not v:
+                del ts[k]
+
+        c.execute('select max(last_time) from devices;')
+        since = c.fetchone()[0]
+        dev_type.update(get_dev_type(c, dev_watermark))
+        dev_watermark = since
+
+        # only the first tick waits for the check
+        wait_check(args)
+        if args.verbose:
+            print(f':: {kept} new packets, {dropped} dropped, {sum(len(v) for v in ts.values())} in the time window')
+        macs, times = filter_lanes(ts, dev_type, args)
+        macs, times = merge_macs(macs, [list(t) for t in times], args)
+        if len(macs) > 0:
+            fig = plot_data(macs, times, args, fig)
+        elif args.verbose:
+            print(':: Nothing to plot')
+        if args.profile:
+            # one report per tick
+            args.profiler.report(args.profile)
+            args.profiler.stages = []
+
+        wait = max(0, args.follow - (time.monotonic()-tick))
+        if args.image or fig is None:
+            time.sleep(wait)
+        elif not plt.fignum_exists(fig.number):
+            # the window has been closed
+            break
+        else:
+            plt.pause(wait)
+    conn.close()
+
+def get_label(mac, args):
+    if mac != 'LAA' and mac not in args.knownmac and is_local_bit_set(mac):
+        return '%s (LAA)' % mac
+    return mac
+
+def draw_lines(ax, macs, times, args):
+    # one Line2D per mac
+    fig = ax.get_figure()
     # calculate size of marker given the number of macs to display and convert from inch to point
     markersize = (fig.get_figheight()/len(macs))*72
     # set default line style for the plot
@@ -199,17 +1383,507 @@ def plot_data(macs, times, args):
         else:
             line, = ax.plot(p, q, label=label)
         if args.label:
-            ax.text(args.end_time, q[-1], label, fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+            ax.text(args.end_time.timestamp(), q[-1], label, fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
         lines.append(line)
+    return lines
+
+def get_colors(macs, args):
+    # known mac in red, LAA in gray and our color cycle for the others
+    colors = []
+    k = 0
+    for m in macs:
+        if m in args.knownmac:
+            colors.append('tab:red')
+        elif m == 'LAA' or is_local_bit_set(m):
+            colors.append('tab:gray')
+        else:
+            colors.append(COLORS[k % len(COLORS)])
+            k += 1
+    return colors
+
+def draw_collection(ax, macs, times, args):
+    # one marker only Line2D per color class and all the dotted lines in a
+    # single LineCollection, instead of one Line2D per mac
+    fig = ax.get_figure()
+    colors = get_colors(macs, args)
+    # calculate size of marker given the number of macs to display and convert from inch to point
+    markersize = (fig.get_figheight()/len(macs))*72
+    # reverse order to get most frequent at top
+    ys = np.arange(len(times)-1, -1, -1, dtype=float)
+    for color in dict.fromkeys(colors):
+        indx = [i for i,c in enumerate(colors) if c == color]
+        x = np.concatenate([np.asarray(times[i], dtype=float) for i in indx])
+        y = np.repeat(ys[indx], [len(times[i]) for i in indx])
+        ax.plot(x, y, color=color, linestyle='', marker='|', markersize=markersize)
+    # dotted line from first to last packet of each mac
+    segs = np.empty((len(times), 2, 2))
+    segs[:,0,0] = [np.min(p) for p in times]
+    segs[:,1,0] = [np.max(p) for p in times]
+    segs[:,0,1] = ys
+    segs[:,1,1] = ys
+    ax.add_collection(mcollections.LineCollection(segs, colors=colors, linewidths=0.3, linestyles=':'))
+    if args.label:
+        for n,m in zip(ys, macs):
+            ax.text(args.end_time.timestamp(), n, get_label(m, args), fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+    # proxy artists for the legend
+    return [matplotlib.lines.Line2D([], [], color=c, label=get_label(m, args)) for m,c in zip(macs, colors)]
+
+def get_xlim(args):
+    # avoid too much space around our data by defining set
+    space = datetime.timedelta(minutes=5) # 5 minutes
+    return (args.start_time-space).timestamp(), (args.end_time+space).timestamp()
+
+def bin_lanes(times, colors, x0, x1, nbins):
+    # bin the packets of each mac in nbins time buckets between x0 and x1, as
+    # a mac x bucket RGBA image in the colors of the timelines, with an
+    # opacity growing with the density
+    counts = np.zeros((len(times), nbins), dtype=np.int64)
+    for i,p in enumerate(times):
+        # reverse order to get most frequent at top
+        n = len(times)-i-1
+        b = ((np.asarray(p, dtype=float)-x0)*(nbins/(x1-x0))).astype(np.int64)
+        counts[n] = np.bincount(np.clip(b, 0, nbins-1), minlength=nbins)
+    img = np.zeros((len(times), nbins, 4), dtype=np.float32)
+    img[:,:,:3] = matplotlib.colors.to_rgba_array(colors)[::-1,None,:3]
+    cmax = counts.max()
+    if cmax > 0:
+        img[:,:,3] = np.where(counts > 0, 0.3+0.7*np.log1p(counts)/np.log1p(cmax), 0)
+    return img
+
+def draw_heatmap(ax, macs, times, args):
+    # bin the packets of each mac in time buckets of one pixel wide, and draw
+    # the mac x bucket matrix as a single image: the cost only depends on the
+    # resolution, not on the number of packets
+    fig = ax.get_figure()
+    if args.image:
+        width = args.size[0]
+    else:
+        width = fig.get_figwidth()*fig.dpi
+    # our axes use 90% of the width of the figure
+    nbins = max(1, int(width*0.9))
+    x0, x1 = get_xlim(args)
+    colors = get_colors(macs, args)
+    img = bin_lanes(times, colors, x0, x1, nbins)
+    ax.imshow(img, extent=(x0, x1, -0.5, len(times)-0.5), aspect='auto', origin='lower', interpolation='nearest')
+    if args.label:
+        for i,m in enumerate(macs):
+            ax.text(args.end_time.timestamp(), len(times)-i-1, get_label(m, args), fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+    # proxy artists for the legend
+    return [matplotlib.lines.Line2D([], [], color=c, label=get_label(m, args)) for m,c in zip(macs, colors)]
+
+class LodView(object):
+    # interactive viewer drawing only the visible time range, at the
+    # resolution of the screen: binned while there are too many packets to
+    # draw, and the packets themselves once zoomed in enough
+    def __init__(self, ax, macs, times, args):
+        self.ax = ax
+        self.colors = get_colors(macs, args)
+        # sorted lanes, to find the packets of a range with a binary search
+        self.lanes = [np.sort(np.asarray(p, dtype=float)) for p in times]
+        self.markersize = (ax.get_figure().get_figheight()/len(macs))*72
+        self.levels = collections.OrderedDict()
+        self.artists = []
+        self.current = None
+        self.timer = ax.get_figure().canvas.new_timer(interval=LOD_DEBOUNCE)
+        self.timer.single_shot = True
+        self.timer.add_callback(self.update)
+        ax.callbacks.connect('xlim_changed', self.changed)
+
+    def changed(self, ax):
+        # wait for the pan or zoom to end
+        self.timer.stop()
+        self.timer.start()
+
+    def get_level(self, x0, x1, nbins):
+        key = (round(x0), round(x1), nbins)
+        if key in self.levels:
+            self.levels.move_to_end(key)
+            return key, self.levels[key]
+        bounds = [(np.searchsorted(l, x0), np.searchsorted(l, x1, side='right')) for l in self.lanes]
+        if sum(hi-lo for lo,hi in bounds) <= LOD_POINTS:
+            level = ('packets', [l[lo:hi] for l,(lo,hi) in zip(self.lanes, bounds)])
+        else:
+            visible = [l[lo:hi] for l,(lo,hi) in zip(self.lanes, bounds)]
+            level = ('bins', bin_lanes(visible, self.colors, x0, x1, nbins))
+        self.levels[key] = level
+        if len(self.levels) > LOD_CACHE:
+            self.levels.popitem(last=False)
+        return key, level
+
+    def update(self, xlim=None):
+        x0, x1 = xlim or self.ax.get_xlim()
+        nbins = max(1, int(self.ax.get_window_extent().width))
+        key, (kind, data) = self.get_level(x0, x1, nbins)
+        if key == self.current:
+            return
+        self.current = key
+        for a in self.artists:
+            a.remove()
+        self.artists = []
+        if kind == 'bins':
+            self.artists.append(self.ax.imshow(data, extent=(x0, x1, -0.5, len(self.lanes)-0.5), aspect='auto', origin='lower', interpolation='nearest'))
+        else:
+            # one marker only Line2D per color class, like draw_collection
+            ys = np.arange(len(data)-1, -1, -1, dtype=float)
+            for color in dict.fromkeys(self.colors):
+                indx = [i for i,c in enumerate(self.colors) if c == color]
+                x = np.concatenate([data[i] for i in indx])
+                y = np.repeat(ys[indx], [len(data[i]) for i in indx])
+                self.artists.extend(self.ax.plot(x, y, color=color, linestyle='', marker='|', markersize=self.markersize))
+        # imshow and plot change the limits
+        self.ax.set_xlim(x0, x1, emit=False)
+        self.ax.set_ylim(-1, len(self.lanes))
+        self.ax.get_figure().canvas.draw_idle()
+
+def draw_lod(ax, macs, times, args):
+    # draw the overview, then follow the changes of the view
+    view = LodView(ax, macs, times, args)
+    # the callbacks of matplotlib are weak references: the axes keep the view alive
+    ax.lod_view = view
+    view.update(get_xlim(args))
+    if args.label:
+        for i,m in enumerate(macs):
+            ax.text(args.end_time.timestamp(), len(times)-i-1, get_label(m, args), fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+    # proxy artists for the legend
+    return [matplotlib.lines.Line2D([], [], color=c, label=get_label(m, args)) for m,c in zip(macs, view.colors)]
+
+def get_intervals(times, gap):
+    # compress the timestamps of each mac into presence intervals (first, last,
+    # number of packets), split where the mac was idle for more than gap seconds
+    intervals = []
+    for p in times:
+        # lanes are in scan order, which is almost always time order already
+        t = np.sort(np.asarray(p, dtype=np.int64))
+        breaks = np.flatnonzero(np.diff(t) > gap)
+        first = np.concatenate(([0], breaks+1))
+        last = np.concatenate((breaks, [len(t)-1]))
+        intervals.append((t[first], t[last], last-first+1))
+    return intervals
+
+def get_idle_periods(intervals, gap):
+    # periods longer than gap seconds without any mac, from the union of the
+    # intervals instead of sorting every packet
+    starts = np.concatenate([s for s,_,_ in intervals])
+    ends = np.concatenate([e for _,e,_ in intervals])
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    # end of the union of all the intervals started so far
+    ends = np.maximum.accumulate(ends[order])
+    idle = np.flatnonzero(starts[1:] - ends[:-1] > gap)
+    return ends[idle], starts[idle+1]
+
+def write_intervals(filename, macs, intervals):
+    with open(filename, 'w') as f:
+        print('mac,start,end,packets', file=f)
+        for m,(starts, ends, counts) in zip(macs, intervals):
+            for s,e,n in zip(starts.tolist(), ends.tolist(), counts.tolist()):
+                print(f'{m},{s},{e},{n}', file=f)
+
+def iter_chunks(lanes, dtype):
+    # values of all the lanes, at most EXPORT_CHUNK at a time
+    for lane in lanes:
+        for i in range(0, len(lane), EXPORT_CHUNK):
+            yield np.asarray(lane[i:i+EXPORT_CHUNK], dtype=dtype)
+
+def write_npy(zf, name, dtype, length, chunks):
+    # a .npy member of a npz, its header telling the length before the data
+    dtype = np.dtype(dtype)
+    with zf.open(name+'.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_1_0(f, {'descr':np.lib.format.dtype_to_descr(dtype), 'fortran_order':False, 'shape':(length,)})
+        for chunk in chunks:
+            f.write(chunk.tobytes())
+
+def write_npz(filename, macs, columns):
+    # macs, offsets (the values of macs[i] being [offsets[i]:offsets[i+1]]) and
+    # one array per column, as np.load reads them
+    lengths = [len(lane) for lane in next(iter(columns.values()))[1]]
+    offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    names = np.array(macs, dtype=str)
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+        write_npy(zf, 'macs', names.dtype, len(names), [names])
+        write_npy(zf, 'offsets', offsets.dtype, len(offsets), [offsets])
+        for name, (dtype, lanes) in columns.items():
+            write_npy(zf, name, dtype, int(offsets[-1]), iter_chunks(lanes, dtype))
+
+def write_parquet(filename, macs, columns):
+    # one row per packet, the mac being dictionary encoded, in row groups of
+    # about EXPORT_CHUNK rows
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print('Error: pyarrow is needed to export to parquet (or use a .npz file)', file=sys.stderr)
+        sys.exit(-1)
+    fields = [('mac', pa.dictionary(pa.int32(), pa.string()))]
+    fields += [(name, pa.from_numpy_dtype(np.dtype(dtype))) for name, (dtype, _) in columns.items()]
+    schema = pa.schema(fields)
+    dictionary = pa.array(macs, type=pa.string())
+    with pq.ParquetWriter(filename, schema) as writer:
+        batches = []
+        rows = 0
+        for i in range(len(macs)):
+            chunks = [iter_chunks([lanes[i]], dtype) for dtype, lanes in columns.values()]
+            for values in zip(*chunks):
+                codes = pa.array(np.full(len(values[0]), i, dtype=np.int32))
+                arrays = [pa.DictionaryArray.from_arrays(codes, dictionary)] + [pa.array(v) for v in values]
+                batches.append(pa.record_batch(arrays, schema=schema))
+                rows += len(codes)
+                if rows >= EXPORT_CHUNK:
+                    writer.write_table(pa.Table.from_batches(batches, schema=schema))
+                    batches = []
+                    rows = 0
+        if batches:
+            writer.write_table(pa.Table.from_batches(batches, schema=schema))
+
+def export_timelines(filename, macs, columns, args):
+    # columns are {name: (dtype, one lane per mac)}, written chunk by chunk to
+    # a temporary file first, so that readers never see a partial export
+    tick = time.perf_counter()
+    tmp = f'{filename}.tmp{os.getpid()}'
+    try:
+        if filename.endswith('.parquet'):
+            write_parquet(tmp, macs, columns)
+        else:
+            write_npz(tmp, macs, columns)
+        os.replace(tmp, filename)
+    except OSError as e:
+        print(f'Error: cannot export to {filename} ({e})', file=sys.stderr)
+        sys.exit(-1)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if args.verbose:
+        rows = sum(len(lane) for lane in next(iter(columns.values()))[1])
+        print(f':: Exported {len(macs)} macs and {rows} packets to {filename} in {time.perf_counter()-tick:.2f}s')
+
+def query_stats(c, args, rowids=None):
+    # packets, first and last packet of each mac and datasource, and the
+    # packets of each datasource, aggregated by sqlite with the filters of the plot
+    where, where_args = packets_where(args)
+    if rowids is not None:
+        where += ' and rowid > ? and rowid <= ?'
+        where_args = where_args + list(rowids)
+    sql = 'select mac,datasource,count(*),min(ts_sec),max(ts_sec)'
+    sql += ' from (select sourcemac as mac,ts_sec,datasource from packets where '+where
+    sql += ' union all select destmac,ts_sec,datasource from packets where '+where+') group by mac,datasource'
+    c.execute(sql, where_args + where_args)
+    rows = c.fetchall()
+    c.execute('select datasource,count(*) from packets where '+where+' group by datasource', where_args)
+    return rows, c.fetchall()
+
+def get_stats(args):
+    # per mac stats of the packets of the time window, without loading them
+    # (--mac applies, --min doesn't as they are meant to choose it)
+    classifier = MacClassifier(args)
+    macs = {}
+    datasources = {}
+    sampled = total = 0
+    if len(args.dbs) > 1:
+        dbs = select_dbs(args)
+    else:
+        dbs = args.dbs
+    for db in dbs:
+        if len(args.dbs) > 1:
+            a = copy.copy(args)
+            a.db = db
+        else:
+            a = args
+        try:
+            conn = open_db(a, clamp=len(args.dbs) == 1)
+            c = conn.cursor()
+            # the sorter of the group by is faster with a temp file (in the page cache) than in memory
+            c.execute('pragma temp_store = 0;')
+            with args.profiler.stage('stats') as st:
+                # the aggregates are joined to the type of their device here, once
+                keepthem = get_keepthem(args)
+                c.execute('select devmac,type from devices where phyname = "IEEE802.11" and type in ('+','.join(['?']*len(keepthem))+')', keepthem)
+                dev_type = dict(c.fetchall())
+                if args.stats_sample:
+                    # a block of rowids at a random offset of each stride (not always
+                    # the same one, which could follow a pattern of the writes),
+                    # each read with a seek of the rowid
+                    c.execute('select max(rowid) from packets;')
+                    hi = c.fetchone()[0] or 0
+                    size = max(1, round(hi*args.stats_sample/STATS_BLOCKS))
+                    step = max(size, round(size/args.stats_sample))
+                    rnd = random.Random(0)
+                    blocks = []
+                    for lo in range(0, hi, step):
+                        lo += rnd.randrange(max(1, min(step, hi-lo)-size+1))
+                        blocks.append((lo, min(lo+size, hi)))
+                    sampled += sum(b-a for a,b in blocks)
+                    total += hi
+                else:
+                    blocks = [None]
+                for block in blocks:
+                    rows, counts = query_stats(c, a, block)
+                    for mac, ds, n, first, last in rows:
+                        dev = dev_type.get(mac)
+                        m = mac.lower()
+                        if dev is None or not classifier.keep(m):
+                            continue
+                        s = macs.get(m)
+                        if s is None:
+                            s = macs[m] = {'mac':m, 'type':dev, 'packets':0, 'first':first, 'last':last, 'datasources':{}}
+                        s['packets'] += n
+                        s['first'] = min(s['first'], first)
+                        s['last'] = max(s['last'], last)
+                        s['datasources'][ds] = s['datasources'].get(ds, 0) + n
+                    for ds, n in counts:
+                        datasources[ds] = datasources.get(ds, 0) + n
+                st['macs_out'] = len(macs)
+            conn.close()
+        except sqlite3.DatabaseError as e:
+            failed_check(a, e)
+        wait_check(a)
+
+    stats = {'start':args.start_time.isoformat(), 'end':args.end_time.isoformat(), 'approximate':bool(args.stats_sample),
+        'packets':sum(datasources.values()), 'macs':len(macs), 'datasources':datasources,
+        'devices':sorted(macs.values(), key=lambda s:(-s['packets'], s['mac']))}
+    if args.stats_sample and sampled:
+        # scale the counts of the sample, and estimate the macs never sampled
+        # from the ones sampled once or twice (Chao1 estimator)
+        scale = total/sampled
+        f1 = sum(1 for s in macs.values() if s['packets'] == 1)
+        f2 = sum(1 for s in macs.values() if s['packets'] == 2)
+        stats['macs'] = round(len(macs) + (f1*f1/(2*f2) if f2 else f1*(f1-1)/2))
+        stats['packets'] = round(stats['packets']*scale)
+        stats['datasources'] = {ds:round(n*scale) for ds,n in datasources.items()}
+        for s in macs.values():
+            s['packets'] = round(s['packets']*scale)
+            s['datasources'] = {ds:round(n*scale) for ds,n in s['datasources'].items()}
+    return stats
+
+def write_stats(stats, dest):
+    # sorted table on stdout or in dest, or json if dest ends with .json
+    if dest.endswith('.json'):
+        with open(dest, 'w') as f:
+            json.dump(stats, f, indent=1)
+        return
+    fmt = lambda t: datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+    datasources = sorted(stats['datasources'], key=lambda ds:-stats['datasources'][ds])
+    approx = '~' if stats['approximate'] else ''
+    lines = [f'{approx}{stats["packets"]} packets and {approx}{stats["macs"]} macs between {stats["start"]} and {stats["end"]}']
+    lines.extend(f'{ds}: {approx}{stats["datasources"][ds]} packets' for ds in datasources)
+    lines.append(f'{"mac":17} {"type":14} {"packets":>9} {"first":19} {"last":19}'+''.join(f' {ds[:8]:>8}' for ds in datasources))
+    for s in stats['devices']:
+        counts = ''.join(f' {s["datasources"].get(ds, 0):8}' for ds in datasources)
+        lines.append(f'{s["mac"]:17} {s["type"]:14} {s["packets"]:9} {fmt(s["first"])} {fmt(s["last"])}{counts}')
+    if dest == '-':
+        print('\n'.join(lines))
+    else:
+        with open(dest, 'w') as f:
+            print('\n'.join(lines), file=f)
+
+def draw_presence(ax, macs, intervals, args):
+    # one bar per presence interval, all in a single collection
+    fig = ax.get_figure()
+    colors = get_colors(macs, args)
+    x0, x1 = get_xlim(args)
+    if args.image:
+        width = args.size[0]
+    else:
+        width = fig.get_figwidth()*fig.dpi
+    # at least one pixel wide, for the intervals of a single packet
+    minwidth = (x1-x0)/max(1, width*0.9)
+    sizes = [len(s) for s,_,_ in intervals]
+    left = np.concatenate([s for s,_,_ in intervals]).astype(float)
+    right = np.maximum(np.concatenate([e for _,e,_ in intervals]), left+minwidth)
+    # reverse order to get most frequent at top
+    y = np.repeat(np.arange(len(intervals)-1, -1, -1, dtype=float), sizes)
+    verts = np.empty((len(left), 4, 2))
+    verts[:,:,0] = np.stack((left, left, right, right), axis=1)
+    verts[:,:,1] = np.stack((y-0.4, y+0.4, y+0.4, y-0.4), axis=1)
+    facecolors = matplotlib.colors.to_rgba_array(colors)[np.repeat(np.arange(len(intervals)), sizes)]
+    ax.add_collection(mcollections.PolyCollection(verts, facecolors=facecolors, linewidths=0))
+    if args.label:
+        for i,m in enumerate(macs):
+            ax.text(args.end_time.timestamp(), len(macs)-i-1, get_label(m, args), fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+    # proxy artists for the legend
+    return [matplotlib.lines.Line2D([], [], color=c, label=get_label(m, args)) for m,c in zip(macs, colors)]
+
+def get_format(fig, args):
+    # --format, or the extension of the image (matplotlib's default without one)
+    if args.format:
+        return args.format
+    if isinstance(args.image, str):
+        ext = os.path.splitext(args.image)[1][1:].lower()
+        if ext:
+            return ext
+    return fig.canvas.get_default_filetype()
+
+def save_image(fig, args):
+    fmt = get_format(fig, args)
+    if fmt not in fig.canvas.get_supported_filetypes():
+        print(f'Error: unsupported image format {fmt}', file=sys.stderr)
+        sys.exit(-1)
+    if fmt in VECTOR_FORMATS:
+        # the packets (collections, lines, images and idle spans) are drawn as
+        # bitmaps at --dpi, the axes, ticks, labels and legend stay vectors: the
+        # size of the file and the time to write it don't depend on the packets
+        for ax in fig.axes:
+            for a in (*ax.collections, *ax.lines, *ax.images, *ax.patches):
+                a.set_rasterized(True)
+    width, height = args.size
+    fig.set_size_inches(width/args.dpi, height/args.dpi)
+    with args.profiler.stage('savefig'):
+        fig.savefig(args.image, dpi=args.dpi, format=args.format)
+
+def parse_size(args):
+    # --size WIDTHxHEIGHT in pixels, default to config.HEIGHT x config.WIDTH
+    try:
+        if args.size is None:
+            width, height = config.HEIGHT, config.WIDTH
+        else:
+            width, height = (int(v) for v in args.size.lower().split('x'))
+    except ValueError:
+        width = height = 0
+    if width <= 0 or height <= 0 or args.dpi <= 0:
+        print('Error: --size argument should be of the form WIDTHxHEIGHT (in pixels), and --dpi positive', file=sys.stderr)
+        sys.exit(-1)
+    args.size = (width, height)
+
+def plot_data(macs, times, args, fig=None):
+    load_matplotlib(args)
+    if fig is None:
+        fig, ax = plt.subplots()
+    else:
+        # redraw on the existing figure (follow mode)
+        fig.clf()
+        ax = fig.add_subplot()
+    # change margin around axis to the border
+    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.07)
+    # set our custom color cycler (without red and gray)
+    ax.set_prop_cycle(cycler('color', COLORS))
+
+    # presence intervals of each mac, for the presence renderer and the grey background
+    with args.profiler.stage('intervals') as st:
+        gap = args.idle_gap if args.presence else IDLE_SHADING
+        intervals = get_intervals(times, gap)
+        # intervals spanning idle periods longer than IDLE_SHADING would hide them from the background
+        shading = intervals if gap <= IDLE_SHADING else get_intervals(times, IDLE_SHADING)
+        st.update(rows_in=sum(len(t) for t in times), rows_out=sum(len(s) for s,_,_ in intervals))
+
+    with args.profiler.stage('draw') as st:
+        st['macs_in'] = len(macs)
+        if args.presence:
+            lines = draw_presence(ax, macs, intervals, args)
+        elif args.lod and not args.image and not args.follow:
+            lines = draw_lod(ax, macs, times, args)
+        elif args.heatmap:
+            lines = draw_heatmap(ax, macs, times, args)
+        elif args.renderer == 'lines':
+            lines = draw_lines(ax, macs, times, args)
+        else:
+            lines = draw_collection(ax, macs, times, args)
 
     # add a grey background on period greater than 15 minutes without data
-    alltimes = []
-    for t in times:
-       alltimes.extend(t)
-    alltimes.sort()
-    diff = [i for i,j in enumerate(zip(alltimes[:-1], alltimes[1:])) if (j[1]-j[0])>60*15]
-    for i in diff:
-        ax.axvspan(alltimes[i], alltimes[i+1], facecolor='#bbbbbb', alpha=0.5)
+    with args.profiler.stage('gaps') as st:
+        idle_starts, idle_ends = get_idle_periods(shading, IDLE_SHADING)
+        for s,e in zip(idle_starts, idle_ends):
+            ax.axvspan(s, e, facecolor='#bbbbbb', alpha=0.5)
+        st.update(rows_out=len(idle_starts))
 
     # define helper function for labels and ticks
     def showdate(tick, pos):
@@ -279,13 +1953,12 @@ def plot_data(macs, times, args):
         ax.legend(lines, macs, loc='lower left', ncol=len(macs)//30+1,
             handler_map={matplotlib.lines.Line2D: MyLine2DHandler()}, prop={'family':'monospace', 'size':8})
     # avoid too much space around our data by defining set
-    space = datetime.timedelta(minutes=5) # 5 minutes
-    ax.set_xlim((args.start_time-space).timestamp(), (args.end_time+space).timestamp())
+    ax.set_xlim(get_xlim(args))
     ax.set_ylim(-1, len(macs))
     # add a title to the image
     if args.title is not None:
         if args.title == '':
-            ts = time.localtime(os.stat(args.db).st_mtime)
+            ts = time.localtime(max(os.stat(db).st_mtime for db in args.dbs))
             title = time.strftime('%Y-%m-%d %H:%M:%S', ts)
         else:
             title = args.title
@@ -293,34 +1966,64 @@ def plot_data(macs, times, args):
 
     # and tada !
     if args.image:
-        fig.set_size_inches(config.HEIGHT/config.DPI, config.WIDTH/config.DPI)
-        fig.savefig(args.image, dpi=config.DPI)
-        #fig.savefig('test.svg', format='svg')
+        save_image(fig, args)
+    elif args.follow:
+        fig.canvas.draw_idle()
     else:
         plt.show()
+    return fig
 
-def main():
-    parser = argparse.ArgumentParser(description="Plot a timeline of devices' activity as captured by kismet")
+def parse_args(argv=None, allow_abbrev=True):
+    parser = argparse.ArgumentParser(description="Plot a timeline of devices' activity as captured by kismet", allow_abbrev=allow_abbrev)
     parser.add_argument('--ap', action='store_true', default=False, help='show APs')
     parser.add_argument('--bridged', action='store_true', default=False, help='show bridged wifi devices')
     parser.add_argument('--no-devices', action='store_true', default=False, help='do not show wifi devices/clients')
-    parser.add_argument('-b', '--db', help='file name of the kismet db')
+    parser.add_argument('-b', '--db', nargs='+', action='extend', help='file name(s) or glob of the kismet db')
+    parser.add_argument('--export', metavar='FILE', default=None, help='write the timelines to FILE (npz, or parquet if it ends with .parquet) instead of plotting them')
+    parser.add_argument('--build-index', metavar='COPY', default=None, help='copy the db to COPY with covering indexes for --sql, and exit')
+    parser.add_argument('--cache', action='store_true', default=False, help='use (and build) a cache of the extracted packets')
+    parser.add_argument('--cache-dir', default=None, help='directory of the cache (default to next to the db)')
+    parser.add_argument('--check', choices=('none', 'header', 'full'), default=config.CHECK, help='integrity check of the db: none, header and schema only, or full (once per change of the db, in the background)')
+    parser.add_argument('--dpi', type=float, default=config.DPI, help='resolution of the image, and of the packets in a svg or pdf (default to config.DPI)')
+    parser.add_argument('--format', default=None, help='format of the image (png, svg, pdf...), default to the extension of --image')
+    parser.add_argument('--heatmap', action='store_true', default=False, help='draw the density of packets instead of each packet (for long time spans)')
+    parser.add_argument('--idle-gap', type=int, default=300, help='idle time in seconds splitting the presence intervals of a mac (default to 300)')
+    parser.add_argument('--intervals-out', metavar='FILE', default=None, help='write the presence intervals of each mac to FILE (csv)')
     parser.add_argument('-i', '--image', default=None, const='plot.png', nargs='?', help='output an image')
     parser.add_argument('-l', '--legend', action='store_true', default=False, help='add a legend')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of processes to read several dbs (default to the number of cpus)')
     parser.add_argument('--label', action='store_true', default=False, help='add a mac label for each plot')
+    parser.add_argument('-f', '--follow', type=int, nargs='?', const=300, default=None, help='follow a db still being written, redrawing every FOLLOW seconds (default to 300)')
     parser.add_argument('-g', '--merged', action='append', help='OUI mac to merge')
     parser.add_argument('-k', '--knownmac', action='append', help='known mac to highlight in red')
+    parser.add_argument('--numpy', action='store_true', default=False, help='use the columnar numpy engine to load data')
+    parser.add_argument('--sql', action='store_true', default=False, help='filter the devices in sqlite (type and --min) and only fetch the packets of the plotted ones')
+    parser.add_argument('--max-memory', type=int, default=config.MAX_MEMORY, help='memory (in MiB) of the packets timelines above which the largest ones are down-sampled (lists engine)')
     parser.add_argument('-M', '--min', type=int, default=3, help='minimum number of packets for device to be plotted')
+    parser.add_argument('--lod', action='store_true', default=False, help='interactive viewer drawing a binned overview first, then only the visible range at the resolution of the screen')
     parser.add_argument('-m', '--mac', action='append', help='only display that mac')
+    parser.add_argument('--presence', action='store_true', default=False, help='draw a bar for each presence interval of a mac instead of each packet')
     parser.add_argument('-p', '--privacy', action='store_true', default=False, help='merge LAA MAC address')
+    parser.add_argument('-P', '--parallel', type=int, default=1, help='scan a single db in PARALLEL rowid ranges, each in its own process (lists and numpy engines)')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, help='report wall time, cpu time and peak rss of each stage (as a table on stderr, or in PROFILE, as json if it ends with .json)')
+    parser.add_argument('--cprofile', metavar='FILE', default=None, help='run under cProfile and dump the stats to FILE')
+    parser.add_argument('--tracemalloc', metavar='FILE', default=None, help='trace python allocations and write the top ones to FILE')
     parser.add_argument('-r', '--rssi', type=int, default=-99, help='minimal value for RSSI')
+    parser.add_argument('--renderer', choices=('collection', 'lines'), default='collection', help='draw all macs in a few collections or with one line per mac')
     parser.add_argument('-s', '--start', help='start timestamp')
+    parser.add_argument('--size', default=None, help='size of the image in pixels, WIDTHxHEIGHT (default to config.HEIGHT x config.WIDTH)')
+    parser.add_argument('--stats', nargs='?', const='-', default=None, help='only print the packets, first and last packet, and packets per datasource of each mac (as a table on stdout, or in STATS, as json if it ends with .json), to choose --min, --mac or --src')
+    parser.add_argument('--stats-sample', type=float, metavar='FRACTION', default=None, help='estimate --stats from FRACTION of the packets (faster on huge dbs)')
+    parser.add_argument('--snapshot', action='store_true', default=config.SNAPSHOT, help='copy the time window to memory in one short read before querying it (for a db kismet is writing)')
     parser.add_argument('--src', action='append', help='only use that source (by UUID)')
     parser.add_argument('--time-span', default='1d', help='time span (expected format [###d][###h][###m]')
     parser.add_argument('-t', '--title', nargs='?', const='', default=None, help='add a title to the top of image (if none specified, use a timestamp)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='be verbose')
-    # RESERVED: args.span, args.start_time, args.end_time
-    args = parser.parse_args()
+    # RESERVED: args.span, args.start_time, args.end_time, args.dbs, args.profiler, args.checking, args.rowids
+    args = parser.parse_args(argv)
+    args.profiler = Profiler(args.profile is not None)
+    args.checking = None
+    args.rowids = None
 
     # parse time_span
     tmsp = args.time_span
@@ -350,6 +2053,8 @@ def main():
                 print('Error: --time-span argument should be of the form [:number:][d|h|m]')
                 sys.exit(-1)
 
+    parse_size(args)
+
     if args.knownmac is None:
         args.knownmac = config.KNOWNMAC
 
@@ -357,9 +2062,30 @@ def main():
         args.merged = config.MERGED
     args.merged = list(m[:8] for m in args.merged)
 
-    if not args.db or not os.path.exists(args.db):
+    args.dbs = expand_dbs(args.db or [])
+    if not args.dbs:
         print(f'Error: file not found {args.db}', file=sys.stderr)
         sys.exit(-1)
+    for db in args.dbs:
+        if not os.path.exists(db):
+            print(f'Error: file not found {db}', file=sys.stderr)
+            sys.exit(-1)
+    args.db = args.dbs[-1]
+    if args.follow and len(args.dbs) > 1:
+        print('Error: --follow only works with a single db', file=sys.stderr)
+        sys.exit(-1)
+    if args.stats_sample is not None and not 0 < args.stats_sample <= 1:
+        print('Error: --stats-sample should be a fraction in ]0, 1]', file=sys.stderr)
+        sys.exit(-1)
+    if args.follow and args.snapshot:
+        print('Error: --follow already only reads the new packets of each tick, without --snapshot', file=sys.stderr)
+        sys.exit(-1)
+    if args.parallel > 1 and args.snapshot:
+        print('Error: --parallel reads the db from several processes, without --snapshot', file=sys.stderr)
+        sys.exit(-1)
+    if args.cache and args.snapshot:
+        print('Error: --cache extracts the whole packets table, without --snapshot', file=sys.stderr)
+        sys.exit(-1)
 
     if args.start:
         try:
@@ -377,17 +2103,49 @@ def main():
         start_time = end_time - args.time_span
     args.start_time = start_time
     args.end_time = end_time
+    return args
+
+def main():
+    args = parse_args()
+    run_profiled(run, args)
+
+def run(args):
+    if args.build_index:
+        build_index(args)
+        return
+
+    if args.follow:
+        follow(args)
+        return
+
+    if args.stats:
+        write_stats(get_stats(args), args.stats)
+        return
 
     if args.verbose:
         print(':: Gathering data')
     macs, times = get_data(args)
+    if args.verbose:
+        print(f':: Peak memory {get_peak_rss()//1024} MiB')
     if len(times) == 0 or len(macs) == 0:
         print('Error: nothing to plot', file=sys.stderr)
         sys.exit(-1)
 
+    if args.intervals_out:
+        write_intervals(args.intervals_out, macs, get_intervals(times, args.idle_gap))
+
+    if args.export:
+        with args.profiler.stage('export'):
+            export_timelines(args.export, macs, {'times':(np.int64, times)}, args)
+        return
+
     if args.verbose:
         print(':: Plotting data')
+    tick = time.perf_counter()
     plot_data(macs, times, args)
+    if args.verbose:
+        renderer = 'presence' if args.presence else 'heatmap' if args.heatmap else 'lod' if args.lod and not args.image else args.renderer
+        print(f':: Plotted with the {renderer} renderer in {time.perf_counter()-tick:.2f}s')
 
 if __name__ == '__main__':
     try:
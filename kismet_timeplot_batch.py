@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import datetime
+import time
+import matplotlib
+# render without any GUI
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import argparse
+import copy
+import multiprocessing
+import shlex
+import sys
+import os.path
+import os
+
+import kismet_timeplot
+import kismet_timeplot_rssi
+
+VERSION = '0.1'
+
+# columns of each db, loaded once and shared with the rendering processes
+COLUMNS = {}
+# (kind, args) of each image to render
+JOBS = []
+
+def read_jobs(filename):
+    # one set of arguments per line, prefixed by rssi for kismet_timeplot_rssi
+    jobs = []
+    with open(filename) as f:
+        for line in f:
+            tokens = shlex.split(line, comments=True)
+            if not tokens:
+                continue
+            kind = 'timeplot'
+            if tokens[0] in ('timeplot', 'rssi'):
+                kind = tokens.pop(0)
+            jobs.append((kind, tokens))
+    return jobs
+
+def split_jobs(split, base, dbs):
+    # one image per day (or hour) between the first and last packet of the dbs
+    ranges = [r for r in map(kismet_timeplot.get_db_range, dbs) if r[1] is not None]
+    if not ranges:
+        return []
+    first = datetime.datetime.fromtimestamp(min(r[1] for r in ranges))
+    last = datetime.datetime.fromtimestamp(max(r[2] for r in ranges))
+    if split == 'day':
+        step = datetime.timedelta(days=1)
+        current = first.replace(hour=0, minute=0, second=0, microsecond=0)
+        span = '1d'
+        fmt = '%Y-%m-%d'
+    else:
+        step = datetime.timedelta(hours=1)
+        current = first.replace(minute=0, second=0, microsecond=0)
+        span = '1h'
+        fmt = '%Y-%m-%dT%H'
+    jobs = []
+    while current <= last:
+        image = current.strftime(fmt)+'.png'
+        jobs.append(('timeplot', base+['-s', current.strftime('%Y-%m-%dT%H:%M'), '--time-span', span, '-i', image]))
+        current += step
+    return jobs
+
+def load_columns(args):
+    # load each db only once for all the jobs using it
+    for db in args.dbs:
+        if db not in COLUMNS:
+            if args.verbose:
+                print(f':: Loading {db}')
+            a = copy.copy(args)
+            a.db = db
+            COLUMNS[db] = kismet_timeplot.get_columns(a, clamp=False)
+
+def render(i):
+    kind, args = JOBS[i]
+    datas = [COLUMNS[db] for db in args.dbs]
+    kismet_timeplot.clamp_end_time(max((d['last'] for d in datas if d['last'] is not None), default=None), args)
+    if kind == 'rssi':
+        series = kismet_timeplot_rssi.merge_series([kismet_timeplot_rssi.filter_rssi(data, args) for data in datas], args)
+        if len(series) == 0:
+            return args.image, 'nothing to plot'
+        fig = kismet_timeplot_rssi.plot_data(series, args)
+    else:
+        macs, times = kismet_timeplot.get_data_columns(datas, args)
+        if len(macs) == 0:
+            return args.image, 'nothing to plot'
+        fig = kismet_timeplot.plot_data(macs, times, args)
+    plt.close(fig)
+    return args.image, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Render many kismet_timeplot images from a single load of the kismet db',
+        epilog='arguments after -- are added to every job')
+    parser.add_argument('-b', '--db', nargs='+', action='extend', help='file name(s) or glob of the kismet db (for jobs without one)')
+    parser.add_argument('--cache', action='store_true', default=False, help='use (and build) a cache of the extracted packets')
+    parser.add_argument('-f', '--file', help='file with the arguments of one job per line (prefix the line with rssi for kismet_timeplot_rssi)')
+    parser.add_argument('-n', '--processes', type=int, default=os.cpu_count(), help='number of rendering processes (default to the number of cpus)')
+    parser.add_argument('-o', '--output', default='.', help='directory of the images')
+    parser.add_argument('--split-by', choices=('day', 'hour'), help='render one image per day or hour of capture')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='be verbose')
+    args, base = parser.parse_known_args()
+    if base and base[0] == '--':
+        base = base[1:]
+
+    if not args.file and not args.split_by:
+        print('Error: a job file or --split-by is required', file=sys.stderr)
+        sys.exit(-1)
+    dbs = kismet_timeplot.expand_dbs(args.db or [])
+    if args.cache:
+        base.append('--cache')
+
+    jobs = []
+    if args.file:
+        jobs.extend((kind, tokens+base) for kind, tokens in read_jobs(args.file))
+    if args.split_by:
+        jobs.extend(split_jobs(args.split_by, base, dbs))
+    for kind, tokens in jobs:
+        if dbs and '-b' not in tokens and '--db' not in tokens:
+            tokens += ['-b', *dbs]
+        if kind == 'rssi':
+            a = kismet_timeplot_rssi.parse_args(tokens)
+        else:
+            a = kismet_timeplot.parse_args(tokens)
+        if a.image is None:
+            print(f'Error: no image for job {shlex.join(tokens)}', file=sys.stderr)
+            sys.exit(-1)
+        a.image = os.path.join(args.output, a.image)
+        JOBS.append((kind, a))
+
+    tick = time.perf_counter()
+    for _, a in JOBS:
+        load_columns(a)
+    if args.verbose:
+        print(f':: Loaded {len(COLUMNS)} db in {time.perf_counter()-tick:.2f}s')
+
+    os.makedirs(args.output, exist_ok=True)
+    tick = time.perf_counter()
+    try:
+        # forked processes share the loaded columns
+        pool = multiprocessing.get_context('fork').Pool(min(args.processes, len(JOBS)) or 1)
+        results = pool.imap_unordered(render, range(len(JOBS)))
+    except ValueError:
+        pool = None
+        results = map(render, range(len(JOBS)))
+    count = 0
+    for image, error in results:
+        if error:
+            print(f'Error: {image}: {error}', file=sys.stderr)
+        else:
+            count += 1
+            if args.verbose:
+                print(f':: Rendered {image}')
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter()-tick
+    print(f':: Rendered {count} images in {elapsed:.2f}s ({count/elapsed:.2f} images/s)')
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt as k:
+        pass
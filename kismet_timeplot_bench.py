@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import datetime
+import time
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sqlite3
+import sys
+import os.path
+import os
+import tempfile
+import tracemalloc
+
+import kismet_synth
+
+VERSION = '0.1'
+# last packet of the generated dbs, fixed so that runs can be compared
+END = datetime.datetime(2024, 1, 1)
+TIME_SPAN = '1d'
+# startup time budget (in seconds) of the scripts when nothing is plotted
+# (--help, error exits), matplotlib being only imported to plot
+STARTUP_BUDGET = 0.5
+# runs of each startup case, the fastest one being kept
+STARTUP_RUNS = 5
+
+class Stages(object):
+    # wall time, cpu time and peak memory of each stage of a run
+    def __init__(self, traced):
+        self.traced = traced
+        self.results = []
+
+    def run(self, name, func, *args):
+        if self.traced:
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        res = func(*args)
+        stage = {
+            'stage': name,
+            'wall': time.perf_counter()-wall,
+            'cpu': time.process_time()-cpu,
+            # in KiB on linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        if self.traced:
+            stage['peak_traced'] = tracemalloc.get_traced_memory()[1]
+        self.results.append(stage)
+        return res
+
+def run_timeplot(case, stages):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import kismet_timeplot as k
+
+    argv = ['-b', case['db'], '-s', case['start'], '--time-span', TIME_SPAN, '-i', case['image'], '-p']
+    if case['engine'] == 'numpy':
+        argv.append('--numpy')
+    args = k.parse_args(argv)
+    conn = k.connect_db(args)
+    c = conn.cursor()
+    stages.run('check', k.check_db, c, args)
+    if case['engine'] == 'numpy':
+        columns = stages.run('query', k.load_numpy, c, args)
+        rows = sum(len(t) for t,_,_ in columns[0])
+        macs, times = stages.run('filter', k.group_lanes, *columns, args)
+    else:
+        ts, dev_type = stages.run('query', k.load_lists, c, args)
+        rows = sum(len(v) for v in ts.values())//2
+        macs, times = stages.run('filter', k.filter_lanes, ts, dev_type, args)
+    conn.close()
+    macs, times = stages.run('merge', k.merge_macs, macs, times, args)
+    fig = stages.run('render', k.plot_data, macs, times, args)
+    plt.close(fig)
+    return {'rows': rows, 'macs': len(macs)}
+
+def run_rssi(case, stages):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import kismet_timeplot as k
+    import kismet_timeplot_rssi as r
+
+    # the most active device, like a watched mac would be
+    conn = sqlite3.connect(case['db'])
+    mac = conn.execute('select devmac from devices where devmac != ? order by last_time-first_time desc limit 1', (kismet_synth.BROADCAST,)).fetchone()[0]
+    conn.close()
+    argv = ['-b', case['db'], '-s', case['start'], '--time-span', TIME_SPAN, '-i', case['image'], '-m', mac]
+    args = r.parse_args(argv)
+    conn = k.connect_db(args)
+    c = conn.cursor()
+    stages.run('check', k.check_db, c, args)
+    series = stages.run('query', r.load_rssi, c, args)
+    conn.close()
+    fig = stages.run('render', r.plot_data, series, args)
+    plt.close(fig)
+    return {'rows': sum(len(t) for t,_ in series.values()), 'macs': len(series)}
+
+def run_load(case, stages):
+    import kismet_timeplot as k
+
+    # the whole load of the timelines, with the db scanned by case['parallel'] processes
+    argv = ['-b', case['db'], '-s', case['start'], '--time-span', TIME_SPAN, '-p', '--check', 'none', '-P', str(case['parallel'])]
+    if case['engine'] == 'numpy':
+        argv.append('--numpy')
+    args = k.parse_args(argv)
+    macs, times = stages.run('load', k.get_data, args)
+    return {'rows': sum(len(t) for t in times), 'macs': len(macs)}
+
+def run_case(case):
+    # run in its own process, so that the peak memory is the one of this case
+    import config
+    # time the full integrity check, not its remembered result
+    config.CHECK_CACHE = case['image']+'.checks.json'
+    if os.path.exists(config.CHECK_CACHE):
+        os.remove(config.CHECK_CACHE)
+    stages = Stages(case['tracemalloc'])
+    if case['tracemalloc']:
+        tracemalloc.start()
+    if case['script'] == 'rssi':
+        counts = run_rssi(case, stages)
+    elif case['script'] == 'load':
+        counts = run_load(case, stages)
+    else:
+        counts = run_timeplot(case, stages)
+    res = dict(case, **counts)
+    res['stages'] = stages.results
+    res['total'] = sum(s['wall'] for s in stages.results)
+    print(json.dumps(res))
+
+def get_db(workdir, packets, args):
+    # generated dbs are kept and reused between runs with the same parameters
+    name = f'synth_{packets}_{args.devices}_{args.laa}_{args.datasources}_{args.rssi_mean}_{args.rssi_std}.kismet'
+    db = os.path.join(workdir, name)
+    if not os.path.exists(db):
+        if args.verbose:
+            print(f':: Generating {db}', file=sys.stderr)
+        kismet_synth.generate(db+'.tmp', packets, args.devices, args.laa, args.datasources, args.rssi_mean, args.rssi_std,
+            kismet_synth.parse_time_span(TIME_SPAN), END)
+        os.rename(db+'.tmp', db)
+    return db
+
+def check_startup():
+    # time the scripts when they exit before plotting, against STARTUP_BUDGET
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    cases = (
+        ('timeplot --help', ['kismet_timeplot.py', '--help']),
+        ('rssi --help', ['kismet_timeplot_rssi.py', '--help']),
+        ('timeplot no db', ['kismet_timeplot.py', '-b', os.path.join(cwd, 'no such file.kismet')]),
+    )
+    ok = True
+    for name, argv in cases:
+        best = None
+        for _ in range(STARTUP_RUNS):
+            tick = time.perf_counter()
+            subprocess.run([sys.executable, *argv], capture_output=True, cwd=cwd)
+            elapsed = time.perf_counter()-tick
+            best = elapsed if best is None else min(best, elapsed)
+        over = best > STARTUP_BUDGET
+        ok &= not over
+        print(f'{name:16} {best:6.3f}s {"over budget" if over else "ok"}', file=sys.stderr)
+    if not ok:
+        print(f'Error: startup time over the {STARTUP_BUDGET}s budget', file=sys.stderr)
+        sys.exit(-1)
+
+def print_scaling(results):
+    # speedup and efficiency of each number of processes against a single one
+    single = {(r['engine'], r['packets']):r['total'] for r in results if r['parallel'] == 1}
+    print(f'{"engine":6} {"packets":>9} {"procs":>5} {"wall":>8} {"speedup":>8} {"efficiency":>10}', file=sys.stderr)
+    for r in results:
+        base = single.get((r['engine'], r['packets']))
+        line = f'{r["engine"]:6} {r["packets"]:9} {r["parallel"]:5} {r["total"]:8.3f}'
+        if base:
+            line += f' {base/r["total"]:7.2f}x {base/r["total"]/r["parallel"]:9.0%}'
+        print(line, file=sys.stderr)
+
+def get_versions():
+    versions = {'bench': VERSION, 'python': platform.python_version()}
+    try:
+        import numpy, matplotlib
+        versions['numpy'] = numpy.__version__
+        versions['matplotlib'] = matplotlib.__version__
+    except ImportError:
+        pass
+    try:
+        rev = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        if rev.returncode == 0:
+            versions['git'] = rev.stdout.strip()
+    except OSError:
+        pass
+    return versions
+
+def print_table(results, previous=None):
+    old = {}
+    if previous:
+        for r in previous['results']:
+            for s in r['stages']:
+                old[(r['script'], r['engine'], r['packets'], s['stage'])] = s['wall']
+    print(f'{"script":8} {"engine":6} {"packets":>9} {"stage":7} {"wall":>8} {"cpu":>8} {"peak rss":>10}', file=sys.stderr)
+    for r in results:
+        for s in r['stages']:
+            line = f'{r["script"]:8} {r["engine"]:6} {r["packets"]:9} {s["stage"]:7} {s["wall"]:8.3f} {s["cpu"]:8.3f} {s["peak_rss"]//1024:7} MiB'
+            before = old.get((r['script'], r['engine'], r['packets'], s['stage']))
+            if before:
+                line += f' {s["wall"]/before:6.2f}x'
+            print(line, file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark kismet_timeplot on synthetic kismet dbs')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('-c', '--compare', help='previous json results to compare with')
+    parser.add_argument('-d', '--devices', type=int, default=1000, help='number of devices of the generated dbs')
+    parser.add_argument('--datasources', type=int, default=2, help='number of datasources of the generated dbs')
+    parser.add_argument('-e', '--engines', default='lists,numpy', help='comma separated engines of kismet_timeplot to benchmark')
+    parser.add_argument('--laa', type=float, default=0.3, help='fraction of devices with a LAA mac')
+    parser.add_argument('-o', '--output', help='write the json results to that file (default to stdout)')
+    parser.add_argument('--rssi-mean', type=float, default=-70, help='mean of the RSSI of the generated dbs')
+    parser.add_argument('--rssi-std', type=float, default=10, help='standard deviation of the RSSI of the generated dbs')
+    parser.add_argument('-s', '--scales', default='10000,100000,1000000', help='comma separated number of packets')
+    parser.add_argument('--scaling', type=int, metavar='N', default=None, help='only benchmark the load of the timelines with a single db scanned by 1 to N processes')
+    parser.add_argument('--scripts', default='timeplot,rssi', help='comma separated scripts to benchmark')
+    parser.add_argument('--startup', action='store_true', default=False, help=f'only check the startup time of the scripts against the {STARTUP_BUDGET}s budget')
+    parser.add_argument('--tracemalloc', action='store_true', default=False, help='also record the peak of traced python allocations (slower)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='be verbose')
+    parser.add_argument('-w', '--workdir', default=None, help='directory of the generated dbs (default to a temporary one)')
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(json.loads(args.case))
+        return
+    if args.startup:
+        check_startup()
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='kismet_timeplot_bench')
+    os.makedirs(workdir, exist_ok=True)
+    start = (END - datetime.timedelta(seconds=kismet_synth.parse_time_span(TIME_SPAN))).strftime('%Y-%m-%dT%H:%M')
+    cases = []
+    for packets in (int(n) for n in args.scales.split(',')):
+        db = get_db(workdir, packets, args)
+        if args.scaling:
+            for engine in args.engines.split(','):
+                for n in range(1, args.scaling+1):
+                    cases.append({'script': 'load', 'engine': engine, 'packets': packets, 'devices': args.devices, 'db': db,
+                        'start': start, 'image': os.path.join(workdir, f'load_{engine}_{packets}_{n}.png'), 'tracemalloc': False, 'parallel': n})
+            continue
+        for script in args.scripts.split(','):
+            engines = args.engines.split(',') if script == 'timeplot' else ['lists']
+            for engine in engines:
+                cases.append({'script': script, 'engine': engine, 'packets': packets, 'devices': args.devices, 'db': db,
+                    'start': start, 'image': os.path.join(workdir, f'{script}_{engine}_{packets}.png'), 'tracemalloc': args.tracemalloc})
+    results = []
+    for case in cases:
+        name = f'{case["script"]} ({case["engine"]}) on {case["packets"]} packets'
+        if 'parallel' in case:
+            name += f' with {case["parallel"]} processes'
+        if args.verbose:
+            print(f':: Running {name}', file=sys.stderr)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if out.returncode != 0:
+            print(f'Error: {name} failed\n{out.stderr}', file=sys.stderr)
+            continue
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    if args.scaling:
+        print_scaling(results)
+    else:
+        previous = None
+        if args.compare:
+            with open(args.compare) as f:
+                previous = json.load(f)
+        print_table(results, previous)
+    doc = {'versions': get_versions(), 'date': datetime.datetime.now().isoformat(timespec='seconds'), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=1)
+    else:
+        print(json.dumps(doc, indent=1))
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt as k:
+        pass
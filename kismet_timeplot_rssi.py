@@ -2,12 +2,7 @@
 
 import datetime
 import time
-from cycler import cycler
-import matplotlib
-#matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import matplotlib.patches as mpatches
+import numpy as np
 import argparse
 import sqlite3
 import sys
@@ -22,6 +17,24 @@ COLORS = ['tab:blue', 'tab:orange', 'tab:green', 'tab:purple', 'tab:brown', 'tab
 
 # read config variable from config.py file
 import config
+# share the packets cache with kismet_timeplot
+from kismet_timeplot import BATCH_SIZE, open_db, wait_check, failed_check, get_columns, get_window, expand_dbs, select_dbs, map_dbs, Profiler, run_profiled, export_timelines, save_image, parse_size
+
+# matplotlib is only imported when something is plotted, see load_matplotlib
+matplotlib = plt = ticker = mpatches = None
+
+def load_matplotlib(args):
+    # deferred import of matplotlib, with the non-interactive Agg backend
+    # (no GUI backend discovery) when only writing an image
+    global matplotlib, plt, ticker, mpatches
+    if plt is not None:
+        return
+    import matplotlib
+    if args.image:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import matplotlib.patches as mpatches
 
 # draws a rectangle as custom legend handler
 class MyLine2DHandler(object):
@@ -36,100 +49,227 @@ def is_local_bit_set(mac):
     byte = mac.split(':')
     return int(byte[0], 16) & 0b00000010 == 0b00000010
 
-def get_data(args):
-    if args.verbose:
-        print(f':: Processing kismet file {args.db}')
-    # sqlite3
-    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
-    c = conn.cursor()
-    sql = 'pragma quick_check;'
+def get_data_cache(args, clamp=True):
+    return filter_rssi(get_columns(args, clamp), args)
+
+def filter_rssi(data, args):
+    # rssi of each of args.mac from already loaded columns (cache or batch mode)
+    index = {m:i for i,m in enumerate(data['macs'])}
+    codes = {index[m]:m for m in args.mac if m in index}
+    if not codes:
+        return {}
+    (start_sec, start_usec), (end_sec, end_usec) = get_window(args)
+    ts_sec = data['ts_sec']
+    ts_usec = data['ts_usec']
+    signal = data['signal']
+    with args.profiler.stage('filter') as st:
+        mask = np.isin(data['src'], list(codes))
+        mask &= ((ts_sec > start_sec) | ((ts_sec == start_sec) & (ts_usec >= start_usec)))
+        mask &= ((ts_sec < end_sec) | ((ts_sec == end_sec) & (ts_usec <= end_usec)))
+        mask &= (signal >= args.rssi) & (signal != 0)
+        if args.datasource:
+            ds = [i for i,s in enumerate(data['datasources']) if s in args.datasource]
+            mask &= np.isin(data['datasource'], ds)
+        src = data['src'][mask]
+        t = ts_sec[mask]
+        r = signal[mask]
+        series = {}
+        for code, m in codes.items():
+            sel = src == code
+            if sel.any():
+                series[m] = (t[sel].tolist(), r[sel].tolist())
+        st.update(rows_in=len(ts_sec), rows_out=len(t), macs_out=len(series))
+    return series
+
+def merge_series(parts, args):
+    # one series per mac out of the series of several dbs, in the order of args.mac
+    series = {}
+    for m in args.mac:
+        times = []
+        rssis = []
+        for part in parts:
+            if m in part:
+                times.extend(part[m][0])
+                rssis.extend(part[m][1])
+        if times:
+            series[m] = (times, rssis)
+    return series
+
+def get_data_db(args):
+    # one of several dbs, the time window being already set
+    return get_data(args, clamp=False)
+
+def get_data_multi(args):
+    # the stages run in the pool are not reported, only the whole load
+    with args.profiler.stage('load dbs') as st:
+        # dbs are sorted on their first packet, so times stay in order
+        series = merge_series(map_dbs(get_data_db, select_dbs(args), args), args)
+        st.update(rows_out=sum(len(t) for t,_ in series.values()), macs_out=len(series))
+    return series
+
+def get_data(args, clamp=True):
+    if clamp and len(args.dbs) > 1:
+        return get_data_multi(args)
+    if args.cache:
+        return get_data_cache(args, clamp)
     try:
-        c.execute(sql)
-        res = c.fetchone()[0]
-        if res != 'ok':
-            raise sqlite3.DatabaseError()
-    except sqlite3.DatabaseError:
-        print(f'Error: {args.db} db failed integrity check')
-        sys.exit(1)
-
-    sql = 'pragma query_only = on;'
-    c.execute(sql)
-    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
-    c.execute(sql)
-    sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
-    c.execute(sql)
-    conn.commit()
-
-    # use last packet ts_sec
-    #sql = 'select ts_sec from packets where phyname="IEEE802.11" order by ts_sec asc limit 1;'
-    #c.execute(sql)
-    #ts_sec_first = datetime.datetime.fromtimestamp(c.fetchone()[0])
-    sql = 'select ts_sec from packets where phyname="IEEE802.11" order by ts_sec desc limit 1;'
-    c.execute(sql)
-    res = c.fetchone()
-    if not res:
-        print('Error: no packet found', file=sys.stderr)
-        sys.exit(1)
-    ts_sec_last = datetime.datetime.fromtimestamp(res[0])
-    if args.end_time > ts_sec_last:
-        args.end_time = ts_sec_last
-        if not args.start:
-            args.start_time = args.end_time - args.time_span
+        conn = open_db(args, clamp)
+        c = conn.cursor()
+        series = load_rssi(c, args)
+        conn.close()
+    except sqlite3.DatabaseError as e:
+        # corruption met before the background check found it
+        failed_check(args, e)
+    wait_check(args)
+    return series
 
+def load_rssi(c, args):
+    # all the macs in a single scan of the packets table, with the time window,
+    # rssi and datasource filters pushed down to sqlite
+    (start_sec, start_usec), (end_sec, end_usec) = get_window(args)
+    # kismet writes macs upper case: ask for both cases rather than calling lower() on each row
+    macs = list(dict.fromkeys(m for mac in args.mac for m in (mac.upper(), mac)))
+    sql = 'select ts_sec,lower(sourcemac),signal from packets where phyname="IEEE802.11"'
+    sql += ' and sourcemac in ('+','.join(['?']*len(macs))+')'
+    sql += ' and (ts_sec > ? or (ts_sec = ? and ts_usec >= ?)) and (ts_sec < ? or (ts_sec = ? and ts_usec <= ?))'
+    sql += ' and signal >= ? and signal != 0'
+    sql_args = [*macs, start_sec, start_sec, start_usec, end_sec, end_sec, end_usec, args.rssi]
     if args.datasource:
-        sql = 'select ts_sec,ts_usec,signal from packets where phyname="IEEE802.11" and sourcemac=? and datasource in ('+','.join(['?']*len(args.datasource))+');'
-        sql_args = (args.mac.upper(), *args.datasource)
+        sql += ' and datasource in ('+','.join(['?']*len(args.datasource))+')'
+        sql_args.extend(args.datasource)
+    series = {m:([], []) for m in args.mac}
+    with args.profiler.stage('query') as st:
+        c.execute(sql, sql_args)
+        kept = 0
+        while True:
+            rows = c.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            kept += len(rows)
+            for ts_sec, mac, signal in rows:
+                times, rssis = series[mac]
+                times.append(ts_sec)
+                rssis.append(signal)
+        series = {m:s for m,s in series.items() if s[0]}
+        st.update(rows_out=kept, macs_out=len(series))
+    return series
+
+def smooth_rssi(times, rssis, window, how):
+    # aggregate the rssi over windows of window seconds, sorting once by
+    # (window, rssi) instead of looping: returns the center of each non empty
+    # window, the median or mean, and the min/max envelope
+    t = np.asarray(times, dtype=np.int64)
+    r = np.asarray(rssis, dtype=float)
+    b = (t - t.min()) // window
+    order = np.lexsort((r, b))
+    b = b[order]
+    r = r[order]
+    starts = np.flatnonzero(np.concatenate(([True], b[1:] != b[:-1])))
+    counts = np.diff(np.concatenate((starts, [len(b)])))
+    lo = r[starts]
+    hi = r[starts+counts-1]
+    if how == 'mean':
+        mid = np.add.reduceat(r, starts)/counts
     else:
-        sql = 'select ts_sec,ts_usec,signal from packets where phyname="IEEE802.11" and sourcemac=?;'
-        sql_args = (args.mac.upper(),)
-    c.execute(sql, sql_args)
-    times = []
-    rssis = []
-    for row in c.fetchall():
-        ts_sec = datetime.datetime.fromtimestamp(row[0])
-        ts_sec = ts_sec.replace(microsecond=row[1])
-        if ts_sec > args.end_time or ts_sec < args.start_time:
-            continue
-        if row[2] < args.rssi or row[2] == 0:
-            continue
-        times.append(row[0])
-        rssis.append(row[2])
-
-    conn.close()
-
-    return (times, rssis)
-
-def plot_data(times, rssis, args):
+        mid = (r[starts+(counts-1)//2] + r[starts+counts//2])/2
+    x = t.min() + b[starts]*window + window/2
+    # break the line and the band on empty windows
+    gaps = np.flatnonzero(np.diff(b[starts]) > 1) + 1
+    return tuple(np.insert(a, gaps, np.nan) for a in (x, mid, lo, hi))
+
+def get_format_coord(series):
+    # sorted arrays of each series for a nearest packet lookup on mouse over,
+    # in O(log n) per mac instead of a scan of the whole list
+    index = []
+    for m,(times,rssis) in series.items():
+        t = np.asarray(times, dtype=float)
+        order = np.argsort(t, kind='stable')
+        index.append((m, t[order], np.asarray(rssis)[order]))
+    def format_coord(x, y):
+        best = None
+        for m,t,r in index:
+            i = np.searchsorted(t, x)
+            # nearest of the packets before and after x
+            if i == len(t) or (i > 0 and x-t[i-1] < t[i]-x):
+                i -= 1
+            # and of the macs, the one with the closest rssi
+            if best is None or abs(r[i]-y) < abs(best[2]-y):
+                best = (m, t[i], r[i])
+        m, t, r = best
+        return f'{time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t))} {m} {r} dBm'
+    return format_coord
+
+def plot_data(series, args):
+    load_matplotlib(args)
     # set line style
     matplotlib.rc('lines', linestyle='', marker='.', markersize=2)
-    fig, ax = plt.subplots()
+    macs = list(series)
+    if args.small_multiples:
+        # one row per mac, sharing both axes
+        fig, axes = plt.subplots(len(macs), 1, sharex=True, sharey=True, squeeze=False)
+        axes = list(axes[:,0])
+    else:
+        fig, ax = plt.subplots()
+        axes = [ax]*len(macs)
     # change margin around axis to the border
-    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.07)
-    # set our custom color cycler (without red and gray)
-    ax.set_prop_cycle(cycler('color', COLORS))
+    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.07, hspace=0.05)
 
     # plot
     lines = []
-    label = args.mac
-    line, = ax.plot(times, rssis, label=label)
-    if args.label:
-        ax.text(args.end_time, q[-1], label, fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+    with args.profiler.stage('draw') as st:
+        for i,m in enumerate(macs):
+            times, rssis = series[m]
+            ax = axes[i]
+            # our colors (without red and gray), one per mac
+            color = COLORS[i % len(COLORS)]
+            if args.smooth:
+                # a line and a band instead of every packet
+                x, mid, lo, hi = smooth_rssi(times, rssis, args.smooth_window, args.smooth)
+                ax.fill_between(x, lo, hi, color=color, alpha=0.3, linewidth=0)
+                line, = ax.plot(x, mid, color=color, label=m, linestyle='-' if args.smooth != 'envelope' else '', marker='', linewidth=1)
+            else:
+                line, = ax.plot(times, rssis, color=color, label=m)
+            lines.append(line)
+            if args.label:
+                ax.text(args.end_time.timestamp(), rssis[-1], m, fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
+            if args.small_multiples:
+                ax.text(0.01, 0.95, m, transform=ax.transAxes, fontsize=8, color='black', verticalalignment='top', family='monospace', backgroundcolor='white')
+        st.update(rows_in=sum(len(t) for t,_ in series.values()), macs_in=len(macs))
+
+    for ax in dict.fromkeys(axes):
+        customize_axes(ax, args)
+        # show the nearest packet of the macs of this plot on mouse over
+        ax.format_coord = get_format_coord({m:series[m] for m,a in zip(macs, axes) if a is ax})
+    # add a legend
+    if args.legend:
+        # add a custom label handler to draw rectangle instead of default line style
+        axes[0].legend(lines, macs, loc='lower left', ncol=len(macs)//30+1,
+            handler_map={matplotlib.lines.Line2D: MyLine2DHandler()}, prop={'family':'monospace', 'size':8})
+    axes[0].set_ylim(min(min(r) for _,r in series.values()), max(max(r) for _,r in series.values()))
+    # add a title to the image
+    if args.title is not None:
+        if args.title == '':
+            ts = time.localtime(max(os.stat(db).st_mtime for db in args.dbs))
+            title = time.strftime('%Y-%m-%d %H:%M:%S', ts)
+        else:
+            title = args.title
+        fig.text(0.49, 0.97, title, fontsize=8, alpha=0.2)
 
+    # and tada !
+    if args.image:
+        save_image(fig, args)
+    else:
+        plt.show()
+    return fig
+
+def customize_axes(ax, args):
     # define helper function for labels and ticks
     def showdate(tick, pos):
         return time.strftime('%Y-%m-%d', time.localtime(tick))
-    def showtime(tick, pos):
-        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(tick))
     def showhourminute(tick, pos):
         return time.strftime('%H:%M', time.localtime(tick))
     def showhour(tick, pos):
         return time.strftime('%Hh', time.localtime(tick))
-    def showrssi(tick, pos):
-        try:
-            indx = times.index(tick)
-            return rssis[indx]
-        except ValueError:
-            return None
 
     ## customize the appearence of our figure/plot
     ax.xaxis.set_remove_overlapping_locs(False)
@@ -166,52 +306,44 @@ def plot_data(times, rssis, args):
 
     # move down major tick labels not to overwrite minor tick labels and do not show major ticks
     ax.xaxis.set_tick_params(which='major', pad=15, length=0)
-    # customize the label shown on mouse over
-    ax.format_xdata = ticker.FuncFormatter(showtime)
-    ax.format_ydata = ticker.FuncFormatter(showrssi)
     # show vertical bars matching minor ticks
     ax.grid(True, axis='x', which='minor')
-    # add a legend
-    if args.legend:
-        # add a custom label handler to draw rectangle instead of default line style
-        ax.legend(lines, [args.mac], loc='lower left', ncol=1//30+1,
-            handler_map={matplotlib.lines.Line2D: MyLine2DHandler()}, prop={'family':'monospace', 'size':8})
     # avoid too much space around our data by defining set
     space = datetime.timedelta(minutes=5) # 5 minutes
     ax.set_xlim((args.start_time-space).timestamp(), (args.end_time+space).timestamp())
-    ax.set_ylim(min(rssis), max(rssis))
-    # add a title to the image
-    if args.title is not None:
-        if args.title == '':
-            ts = time.localtime(os.stat(args.db).st_mtime)
-            title = time.strftime('%Y-%m-%d %H:%M:%S', ts)
-        else:
-            title = args.title
-        fig.text(0.49, 0.97, title, fontsize=8, alpha=0.2)
 
-    # and tada !
-    if args.image:
-        fig.set_size_inches(config.HEIGHT/config.DPI, config.WIDTH/config.DPI)
-        fig.savefig(args.image, dpi=config.DPI)
-        #fig.savefig('test.svg', format='svg')
-    else:
-        plt.show()
-
-def main():
-    parser = argparse.ArgumentParser(description="Plot a timeline of devices' activity as captured by kismet")
-    parser.add_argument('-b', '--db', help='file name of the kismet db')
+def parse_args(argv=None, allow_abbrev=True):
+    parser = argparse.ArgumentParser(description="Plot a timeline of devices' activity as captured by kismet", allow_abbrev=allow_abbrev)
+    parser.add_argument('-b', '--db', nargs='+', action='extend', help='file name(s) or glob of the kismet db')
+    parser.add_argument('--cache', action='store_true', default=False, help='use (and build) a cache of the extracted packets')
+    parser.add_argument('--cache-dir', default=None, help='directory of the cache (default to next to the db)')
+    parser.add_argument('--check', choices=('none', 'header', 'full'), default=config.CHECK, help='integrity check of the db: none, header and schema only, or full (once per change of the db, in the background)')
     parser.add_argument('-d', '--datasource', action='append', help='filter datasource to use')
+    parser.add_argument('--dpi', type=float, default=config.DPI, help='resolution of the image, and of the packets in a svg or pdf (default to config.DPI)')
+    parser.add_argument('--export', metavar='FILE', default=None, help='write the rssi series to FILE (npz, or parquet if it ends with .parquet) instead of plotting them')
+    parser.add_argument('--format', default=None, help='format of the image (png, svg, pdf...), default to the extension of --image')
     parser.add_argument('-i', '--image', default=None, const='plot.png', nargs='?', help='output an image')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of processes to read several dbs (default to the number of cpus)')
     parser.add_argument('-l', '--legend', action='store_true', default=False, help='add a legend')
     parser.add_argument('--label', action='store_true', default=False, help='add a mac label for each plot')
-    parser.add_argument('-m', '--mac', required=True, help='only display that mac')
+    parser.add_argument('-m', '--mac', action='append', help='display that mac (several times for several macs, default to config.MYDEVICES)')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, help='report wall time, cpu time and peak rss of each stage (as a table on stderr, or in PROFILE, as json if it ends with .json)')
+    parser.add_argument('--cprofile', metavar='FILE', default=None, help='run under cProfile and dump the stats to FILE')
+    parser.add_argument('--tracemalloc', metavar='FILE', default=None, help='trace python allocations and write the top ones to FILE')
     parser.add_argument('-r', '--rssi', type=int, default=-99, help='minimal value for RSSI')
     parser.add_argument('-s', '--start', help='start timestamp')
+    parser.add_argument('--size', default=None, help='size of the image in pixels, WIDTHxHEIGHT (default to config.HEIGHT x config.WIDTH)')
+    parser.add_argument('--snapshot', action='store_true', default=config.SNAPSHOT, help='copy the time window to memory in one short read before querying it (for a db kismet is writing)')
+    parser.add_argument('--smooth', choices=('median', 'mean', 'envelope'), default=None, help='draw the median or mean of the rssi over windows of --smooth-window with their min/max, or only the min/max, instead of each packet')
+    parser.add_argument('--smooth-window', type=int, default=60, help='window of --smooth in seconds (default to 60)')
+    parser.add_argument('--small-multiples', action='store_true', default=False, help='draw each mac in its own plot instead of overlaid')
     parser.add_argument('--time-span', default='1d', help='time span (expected format [###d][###h][###m]')
     parser.add_argument('-t', '--title', nargs='?', const='', default=None, help='add a title to the top of image (if none specified, use a timestamp)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='be verbose')
-    # RESERVED: args.span, args.start_time, args.end_time
-    args = parser.parse_args()
+    # RESERVED: args.span, args.start_time, args.end_time, args.dbs, args.profiler, args.checking
+    args = parser.parse_args(argv)
+    args.profiler = Profiler(args.profile is not None)
+    args.checking = None
 
     # parse time_span
     tmsp = args.time_span
@@ -241,9 +373,29 @@ def main():
                 print('Error: --time-span argument should be of the form [:number:][d|h|m]')
                 sys.exit(-1)
 
-    if not args.db or not os.path.exists(args.db):
+    parse_size(args)
+
+    if args.mac is None:
+        args.mac = config.MYDEVICES
+        if isinstance(args.mac, str):
+            args.mac = (args.mac,)
+    args.mac = list(dict.fromkeys(m.lower() for m in args.mac))
+    if not args.mac:
+        print('Error: no mac to display (use -m or config.MYDEVICES)', file=sys.stderr)
+        sys.exit(-1)
+
+    args.dbs = expand_dbs(args.db or [])
+    if not args.dbs:
         print(f'Error: file not found {args.db}', file=sys.stderr)
         sys.exit(-1)
+    for db in args.dbs:
+        if not os.path.exists(db):
+            print(f'Error: file not found {db}', file=sys.stderr)
+            sys.exit(-1)
+    args.db = args.dbs[-1]
+    if args.cache and args.snapshot:
+        print('Error: --cache extracts the whole packets table, without --snapshot', file=sys.stderr)
+        sys.exit(-1)
 
     if args.start:
         try:
@@ -261,17 +413,29 @@ def main():
         start_time = end_time - args.time_span
     args.start_time = start_time
     args.end_time = end_time
+    return args
 
+def main():
+    args = parse_args()
+    run_profiled(run, args)
+
+def run(args):
     if args.verbose:
         print(':: Gathering data')
-    times, rssis = get_data(args)
-    if len(times) == 0 or len(rssis) == 0:
+    series = get_data(args)
+    if len(series) == 0:
         print('Error: nothing to plot', file=sys.stderr)
         sys.exit(-1)
 
+    if args.export:
+        with args.profiler.stage('export'):
+            export_timelines(args.export, list(series), {'times':(np.int64, [t for t,_ in series.values()]),
+                'rssis':(np.int16, [r for _,r in series.values()])}, args)
+        return
+
     if args.verbose:
         print(':: Plotting data')
-    plot_data(times, rssis, args)
+    plot_data(series, args)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import time
+import matplotlib
+# render without any GUI
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import argparse
+import collections
+import copy
+import io
+import multiprocessing
+import sqlite3
+import sys
+import threading
+import urllib.parse
+import http.server
+
+import kismet_timeplot
+import kismet_timeplot_rssi
+
+VERSION = '0.1'
+# options which can't be given as query parameters (files, processes, interactive modes),
+# or which do nothing on the loaded columns and would only add keys to the image cache
+FORBIDDEN = ('db', 'build-index', 'export', 'stats', 'stats-sample', 'image', 'follow', 'lod', 'jobs', 'parallel', 'cache', 'cache-dir', 'check', 'format', 'profile', 'cprofile',
+    'tracemalloc', 'intervals-out', 'verbose', 'numpy', 'sql', 'snapshot', 'max-memory')
+CONTENT_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+# columns and max(rowid) of each db, loaded once then appended to, and shared with the rendering processes
+COLUMNS = {}
+WATERMARKS = {}
+
+def get_watermark(db):
+    # max(rowid) is cheap and changes as soon as kismet writes a packet
+    conn = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+    rowid = conn.execute('select max(rowid) from packets;').fetchone()[0] or 0
+    conn.close()
+    return rowid
+
+def load_columns(db, base):
+    a = copy.copy(base)
+    a.db = db
+    COLUMNS[db] = kismet_timeplot.get_columns(a, clamp=False)
+    WATERMARKS[db] = COLUMNS[db]['rowid']
+
+def update_columns(db, base, rowid):
+    # only read the packets written since the previous load, like --follow
+    a = copy.copy(base)
+    a.db = db
+    COLUMNS[db] = kismet_timeplot.update_columns(COLUMNS[db], a, rowid)
+    WATERMARKS[db] = rowid
+
+def get_options(query):
+    # query parameters as (option, value) pairs, value None for a flag: ?mac=a&mac=b&privacy gives
+    # [('mac', 'a'), ('mac', 'b'), ('privacy', None)]
+    options = []
+    for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+        key = key.replace('_', '-')
+        if key in FORBIDDEN or not key.replace('-', '').isalnum():
+            raise ValueError(f'option {key} not allowed')
+        options.append((key, None if value in ('', 'true') else value))
+    return options
+
+def get_argv(options):
+    # options as command line options: --mac=a --mac=b --privacy (a value starting
+    # with - can't be taken for another option)
+    argv = []
+    for key, value in options:
+        if value is None:
+            argv.append(f'--{key}')
+        else:
+            argv.append(f'--{key}={value}')
+    return argv
+
+def render(kind, argv, fmt):
+    # in a worker process, with the columns loaded before it was forked; only the
+    # full names of the options, or an abbreviation could reach a FORBIDDEN one
+    if kind == 'rssi':
+        args = kismet_timeplot_rssi.parse_args(argv, allow_abbrev=False)
+    else:
+        args = kismet_timeplot.parse_args(argv, allow_abbrev=False)
+    datas = [COLUMNS[db] for db in args.dbs]
+    kismet_timeplot.clamp_end_time(max((d['last'] for d in datas if d['last'] is not None), default=None), args)
+    args.image = io.BytesIO()
+    args.format = fmt
+    if kind == 'rssi':
+        series = kismet_timeplot_rssi.merge_series([kismet_timeplot_rssi.filter_rssi(data, args) for data in datas], args)
+        if len(series) == 0:
+            return None
+        fig = kismet_timeplot_rssi.plot_data(series, args)
+    else:
+        macs, times = kismet_timeplot.get_data_columns(datas, args)
+        if len(macs) == 0:
+            return None
+        fig = kismet_timeplot.plot_data(macs, times, args)
+    plt.close(fig)
+    return args.image.getvalue()
+
+def call_render(job):
+    # errors of the arguments (argparse exits) are returned to the client
+    try:
+        return 200, render(*job)
+    except SystemExit:
+        return 400, b'bad arguments'
+
+class Server(http.server.ThreadingHTTPServer):
+    def __init__(self, address, args, base):
+        super().__init__(address, Handler)
+        self.args = args
+        self.base = base
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+        # requests being rendered by each pool
+        self.running = collections.Counter()
+        self.start_pool()
+        if args.refresh:
+            threading.Thread(target=self.follow, daemon=True).start()
+
+    def start_pool(self):
+        # forked processes share the loaded columns, so a new pool is needed when
+        # they change, the old one being closed after its last request
+        pool = multiprocessing.get_context('fork').Pool(self.args.processes)
+        with self.lock:
+            old, self.pool = self.pool, pool
+            self.watermarks = tuple(WATERMARKS[db] for db in self.base.dbs)
+            if old is None or self.running[old] > 0:
+                return
+        old.close()
+
+    def done(self, pool):
+        # close a replaced pool after its last request
+        with self.lock:
+            self.running[pool] -= 1
+            if self.running[pool] > 0:
+                return
+            del self.running[pool]
+            if pool is self.pool:
+                return
+        pool.close()
+
+    def follow(self):
+        # read the packets written to the dbs every --refresh seconds, out of the
+        # request lock: the previous columns are served meanwhile
+        while True:
+            time.sleep(self.args.refresh)
+            changed = False
+            for db in self.base.dbs:
+                try:
+                    rowid = get_watermark(db)
+                    if rowid > WATERMARKS[db]:
+                        if self.args.verbose:
+                            print(f':: Reading {db} after rowid {WATERMARKS[db]}', file=sys.stderr)
+                        update_columns(db, self.base, rowid)
+                        changed = True
+                except sqlite3.Error as e:
+                    print(f'Error: {db}: {e}', file=sys.stderr)
+                except SystemExit:
+                    # failed check, already reported: keep the columns read so far
+                    pass
+            if changed:
+                self.start_pool()
+
+    def get_image(self, kind, options, fmt):
+        with self.lock:
+            # same options in any order give the same image, but the values of
+            # an option given several times keep their order (stable sort)
+            key = (kind, fmt, tuple(sorted(options, key=lambda o: o[0])), self.watermarks)
+            if key in self.images:
+                self.images.move_to_end(key)
+                return 200, self.images[key], True
+            pool = self.pool
+            self.running[pool] += 1
+        try:
+            status, image = pool.apply(call_render, ((kind, get_argv(options)+['-b', *self.base.dbs], fmt),))
+        finally:
+            self.done(pool)
+        if status == 200 and image is not None:
+            with self.lock:
+                self.images[key] = image
+                # least recently used images go first
+                while len(self.images) > self.args.cache_size:
+                    self.images.popitem(last=False)
+        return status, image, False
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    server_version = f'kismet_timeplot/{VERSION}'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        kind, _, fmt = url.path.strip('/').partition('.')
+        fmt = fmt or 'png'
+        if kind not in ('timeplot', 'rssi') or fmt not in CONTENT_TYPES:
+            self.reply(404, b'use /timeplot[.png|.svg] or /rssi[.png|.svg]')
+            return
+        try:
+            options = get_options(url.query)
+        except ValueError as e:
+            self.reply(400, str(e).encode())
+            return
+        tick = time.perf_counter()
+        status, image, hit = self.server.get_image(kind, options, fmt)
+        if status != 200:
+            self.reply(status, image)
+        elif image is None:
+            self.reply(404, b'nothing to plot')
+        else:
+            self.reply(200, image, CONTENT_TYPES[fmt], {'X-Cache': 'hit' if hit else 'miss'})
+        if self.server.args.verbose:
+            print(f':: {self.path} {"cached" if hit else "rendered"} in {time.perf_counter()-tick:.2f}s', file=sys.stderr)
+
+    def reply(self, status, body, content_type='text/plain', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k,v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # only log with --verbose
+        if self.server.args.verbose:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve kismet_timeplot images over http, keeping the kismet db loaded',
+        epilog='the options of kismet_timeplot.py (or kismet_timeplot_rssi.py) are given as query parameters: /timeplot.svg?mac=00:11%%25&privacy&time-span=2h')
+    parser.add_argument('-b', '--db', nargs='+', action='extend', required=True, help='file name(s) or glob of the kismet db')
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on (default to localhost only)')
+    parser.add_argument('--cache', action='store_true', default=False, help='use (and build) a cache of the extracted packets')
+    parser.add_argument('--cache-size', type=int, default=256, help='number of rendered images kept in memory (default to 256)')
+    parser.add_argument('-n', '--processes', type=int, default=multiprocessing.cpu_count(), help='number of rendering processes (default to the number of cpus)')
+    parser.add_argument('-p', '--port', type=int, default=8642, help='port to listen on (default to 8642)')
+    parser.add_argument('--refresh', type=int, default=10, help='seconds between two reads of the packets written to the dbs (default to 10, 0 to never read them)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='be verbose')
+    args = parser.parse_args()
+
+    base = kismet_timeplot.parse_args(['-b', *args.db])
+    # the columns are read once then appended to, never through a snapshot
+    base.cache = args.cache
+    for db in base.dbs:
+        if args.verbose:
+            print(f':: Loading {db}', file=sys.stderr)
+        load_columns(db, base)
+    server = Server((args.bind, args.port), args, base)
+    print(f':: Serving on http://{args.bind}:{args.port}/timeplot.png', file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.pool.terminate()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt as k:
+        pass